@@ -5,11 +5,15 @@ Autor: Luis A. Gutiérrez Soto
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from matplotlib.ticker import MultipleLocator
+from matplotlib.figure import Figure
+from matplotlib.ticker import FormatStrFormatter, MultipleLocator
 import argparse
+import io
 import os
 import re
 
+from Jpas_io import read_table
+
 # Configuración de estilo
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams['font.family'] = 'DejaVu Sans'
@@ -48,12 +52,8 @@ def mag_to_flux(mag, mag_err, wavelength, zp=2.41):
     flux_err = (c * 10**(-mag/2.5) * np.log(10)/2.5 ) * mag_err
     return flux, flux_err
 
-def create_sed_plot(row, filters, output_dir, zp):
-    """Genera y guarda un gráfico SED individual"""
-    fig, ax = plt.subplots(figsize=(15, 6))
-    ax.spines[["top", "right"]].set_visible(False)
-    
-    # Recolectar datos
+def sed_points(row, filters, zp):
+    """Longitudes de onda, flujos, errores y colores de las bandas válidas de un objeto"""
     wavelengths, fluxes, flux_errs, colors = [], [], [], []
     
     for _, f in filters.iterrows():
@@ -80,26 +80,26 @@ def create_sed_plot(row, filters, output_dir, zp):
     
     # Validación de consistencia
     assert len(wavelengths) == len(fluxes) == len(flux_errs) == len(colors), "Datos inconsistentes!"
+    return wavelengths, fluxes, flux_errs, colors
+
+def sed_figure(row, filters, zp):
+    """Construye la figura SED de un objeto (sin estado de pyplot, apta para hilos)"""
+    fig = Figure(figsize=(15, 6))
+    ax = fig.add_subplot()
+    ax.spines[["top", "right"]].set_visible(False)
     
-    # Graficar
-    try:
-        ax.errorbar(
-            x=wavelengths,
-            y=fluxes,
-            yerr=flux_errs,
-            fmt='o',
-            markersize=8,
-            ecolor=colors,
-            elinewidth=2,
-            capsize=4,
-            markerfacecolor='white',
-            markeredgecolor=colors,
-            markeredgewidth=1.5
-        )
-    except Exception as e:
-        print(f"❌ Error al graficar: {str(e)}")
-        plt.close()
-        return
+    wavelengths, fluxes, flux_errs, colors = sed_points(row, filters, zp)
+    
+    # Graficar: errorbar no admite un color por punto, así que se colorean
+    # las barras (LineCollection) y se dibujan marcadores y topes aparte
+    if wavelengths:
+        w, fl, fe = np.asarray(wavelengths), np.asarray(fluxes), np.asarray(flux_errs)
+        bars = ax.errorbar(x=w, y=fl, yerr=fe, fmt='none', elinewidth=2)
+        bars[2][0].set_color(colors)
+        for cap in (fl - fe, fl + fe):
+            ax.scatter(w, cap, marker='_', s=64, c=colors, linewidths=2)
+        ax.scatter(w, fl, s=64, facecolors='white', edgecolors=colors,
+                   linewidths=1.5, zorder=3)
     
     # Configuración de ejes
     ax.set_xlabel(r'Longitud de onda ($\AA$)', fontsize=14)
@@ -120,20 +120,28 @@ def create_sed_plot(row, filters, output_dir, zp):
     # Configurar ticks
     ax.xaxis.set_major_locator(MultipleLocator(1000))
     ax.xaxis.set_minor_locator(MultipleLocator(250))
-    ax.yaxis.set_major_formatter(plt.FormatStrFormatter('%.1e'))
-    
-    # Guardar
+    ax.yaxis.set_major_formatter(FormatStrFormatter('%.1e'))
+    fig.tight_layout()
+    return fig
+
+def render_sed(row, filters, zp, fmt="png", dpi=100):
+    """Devuelve la SED de un objeto como bytes PNG/SVG/PDF"""
+    buf = io.BytesIO()
+    sed_figure(row, filters, zp).savefig(buf, format=fmt, dpi=dpi, bbox_inches='tight')
+    return buf.getvalue()
+
+def create_sed_plot(row, filters, output_dir, zp):
+    """Genera y guarda un gráfico SED individual"""
+    fig = sed_figure(row, filters, zp)
     filename = f"sed_{row['number'] if 'number' in row else row.name}.pdf"
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, filename), bbox_inches='tight')
-    plt.close()
+    fig.savefig(os.path.join(output_dir, filename), bbox_inches='tight')
 
 def main():
     parser = argparse.ArgumentParser(
         description="Generador de SEDs para datos JPAS",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument("input_csv", help="Archivo CSV con datos JPAS")
+    parser.add_argument("input_csv", help="Tabla con datos JPAS (CSV, Parquet o FITS)")
     parser.add_argument("-f", "--filters", default="../JPAS-filters.csv",
                       help="Archivo CSV de definición de filtros")
     parser.add_argument("-o", "--output", default="../jpas_seds",
@@ -145,7 +153,7 @@ def main():
     
     try:
         os.makedirs(args.output, exist_ok=True)
-        df = pd.read_csv(args.input_csv)
+        df = read_table(args.input_csv)
         filters = load_jpas_filters(args.filters)
         
         print(f"🔄 Procesando {len(df)} objetos...")
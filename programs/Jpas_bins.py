@@ -0,0 +1,192 @@
+"""
+Bins de magnitud iSDSS con igual número de objetos (plan de shards)
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, numpy (pyvo sólo para consultar el histograma)
+
+Los bins fijos (13–16, 16–17.5, …) producen shards muy desiguales: el bin
+débil domina el tiempo de descarga y de selección. Aquí se pide al
+servidor un histograma de mag iSDSS por tile con una única consulta ADQL
+de agregación (COUNT ... GROUP BY), que se guarda en caché local, y se
+eligen los bordes para que cada bin tenga aproximadamente el mismo número
+de objetos; opcionalmente se corta además un bin antes de que algún tile
+supere `--max_per_tile` objetos (la selección ajusta el locus por tile).
+
+El plan (JSON) lo leen, todos con load_plan, JPAS-data-v2.py /
+JPAS-data-allFilter.py (--plan; una consulta por bin en paralelo),
+Jpas_pipeline.py (--plan), Jpas_sync.py (--plan) y Jpas_worker.py
+(submit download --plan).
+
+Ejemplo:
+    python Jpas_bins.py --n_bins 8 --range 13 24 --step 0.05 -o ../Data/shard_plan.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from Jpas_tap import DEFAULT_RELEASE, QUALITY_WHERE
+
+# Bins fijos de magnitud iSDSS de los scripts de descarga (JPAS-data-v2.py)
+DEFAULT_BINS = [
+    (13.0, 16.0),
+    (16.0, 17.5),
+    (17.5, 18.5),
+    (18.5, 19.5),
+    (19.5, 23.0),
+    (23.0, 24.0)
+]
+MAG_EXPR = "mag_aper_cor_6_0[jpas::iSDSS]"
+
+
+def histogram_query(mag_range, step):
+    """ADQL: número de objetos por tile y por intervalo `step` de mag iSDSS"""
+    mbin = f"FLOOR({MAG_EXPR} / {step})"
+    return f"""
+SELECT tile_id, {mbin} AS mbin, COUNT(*) AS n
+FROM jpas.MagABDualObj
+WHERE {QUALITY_WHERE}
+    AND {MAG_EXPR} >= {mag_range[0]} AND {MAG_EXPR} < {mag_range[1]}
+GROUP BY tile_id, {mbin}
+"""
+
+
+def fetch_histogram(release, mag_range, step, cache_dir, refresh=False):
+    """Histograma (tile_id, mbin, n) desde la caché local o con una consulta TAP"""
+    key = json.dumps({"release": release, "range": list(mag_range), "step": step,
+                      "query": histogram_query(mag_range, step)}, sort_keys=True)
+    path = os.path.join(cache_dir, f"isdss_hist_{release}_"
+                                   f"{hashlib.sha256(key.encode()).hexdigest()[:12]}.json")
+    if os.path.exists(path) and not refresh:
+        print(f"Histograma desde caché: {path}")
+        with open(path) as f:
+            return json.load(f)["rows"], path
+
+    import Jpas_tap
+    service = Jpas_tap.login(release)
+    t0 = time.perf_counter()
+    table = service.run_async(histogram_query(mag_range, step)).to_table()
+    rows = [[int(t), int(m), int(n)] for t, m, n in zip(table["tile_id"], table["mbin"], table["n"])]
+    print(f"Histograma: {len(rows)} celdas (tile × mag) en {time.perf_counter() - t0:.1f} s")
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"release": release, "range": list(mag_range), "step": step,
+                   "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "rows": rows}, f)
+    return rows, path
+
+
+def equal_count_bins(rows, step, n_bins, max_per_tile=None, mag_range=None):
+    """Bordes con ~igual número de objetos por bin a partir del histograma por tile
+
+    Se recorre el histograma en magnitud y se cierra un bin en cada cuantil
+    total/n_bins (en el borde más cercano), o antes si añadir el siguiente
+    intervalo haría que algún tile superase `max_per_tile`.
+    """
+    # numpy sólo aquí: load_plan se usa desde clientes ligeros (Jpas_worker)
+    import numpy as np
+
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+    mbins = np.unique(rows[:, 1])
+    tiles, tile_idx = np.unique(rows[:, 0], return_inverse=True)
+    # Matriz (intervalos de magnitud × tiles)
+    grid = np.zeros((len(mbins), len(tiles)), dtype=np.int64)
+    np.add.at(grid, (np.searchsorted(mbins, rows[:, 1]), tile_idx), rows[:, 2])
+    counts = grid.sum(axis=1)
+    total = int(counts.sum())
+    if max_per_tile:
+        # Bins suficientes para que el tile más poblado quepa bajo el tope
+        n_bins = max(n_bins, int(np.ceil(grid.sum(axis=0).max() / max_per_tile)))
+    target = total / n_bins
+
+    decimals = max(0, -int(np.floor(np.log10(step)))) + 1
+
+    def edge(m):
+        return round(float(m * step), decimals)
+
+    bins, start, done, quantile = [], 0, 0, 1
+    current = np.zeros(len(tiles), dtype=np.int64)
+    for k in range(len(mbins)):
+        n_k = int(counts[k])
+        boundary = quantile * target
+        cum = done + current.sum()
+        over_cap = max_per_tile is not None and (current + grid[k]).max() > max_per_tile
+        near = cum + n_k > boundary and abs(cum - boundary) <= abs(cum + n_k - boundary)
+        if k > start and (over_cap or near):
+            bins.append((start, k, current))
+            done += int(current.sum())
+            start, current = k, np.zeros(len(tiles), dtype=np.int64)
+            # Siguiente cuantil que deje al menos medio bin por delante
+            quantile += int(near)
+            while quantile * target <= done + target / 2:
+                quantile += 1
+        current = current + grid[k]
+    if len(mbins):
+        bins.append((start, len(mbins), current))
+
+    plan = []
+    for i0, i1, per_tile in bins:
+        plan.append({"lo": edge(mbins[i0]), "hi": edge(mbins[i1 - 1] + 1),
+                     "count": int(per_tile.sum()), "max_tile_count": int(per_tile.max())})
+    # Bins contiguos: los huecos del histograma se asignan al bin siguiente
+    for prev, nxt in zip(plan[:-1], plan[1:]):
+        prev["hi"] = nxt["lo"]
+    if plan and mag_range is not None:
+        plan[0]["lo"], plan[-1]["hi"] = float(mag_range[0]), float(mag_range[1])
+    return plan, total
+
+
+def load_plan(path):
+    """Lista de (lo, hi) de un plan de shards"""
+    with open(path) as f:
+        plan = json.load(f)
+    return [(b["lo"], b["hi"]) for b in plan["bins"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bins iSDSS de igual número de objetos desde un histograma del servidor",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-o", "--output", default="../Data/shard_plan.json",
+                        help="Plan de shards (JSON)")
+    parser.add_argument("--n_bins", type=int, default=6,
+                        help="Número de bins (mínimo; --max_per_tile puede añadir más)")
+    parser.add_argument("--range", type=float, nargs=2, default=[13.0, 24.0],
+                        help="Rango de mag iSDSS")
+    parser.add_argument("--step", type=float, default=0.05,
+                        help="Resolución del histograma en magnitudes")
+    parser.add_argument("--max_per_tile", type=int, default=None,
+                        help="Máximo de objetos de un mismo tile por bin")
+    parser.add_argument("--release", default=DEFAULT_RELEASE, help="Data release de JPAS")
+    parser.add_argument("--cache_dir", default="../Data/histograms",
+                        help="Caché local de histogramas")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Volver a consultar el servidor aunque haya caché")
+
+    args = parser.parse_args()
+
+    rows, cache_path = fetch_histogram(args.release, args.range, args.step,
+                                       args.cache_dir, args.refresh)
+    bins, total = equal_count_bins(rows, args.step, args.n_bins, args.max_per_tile, args.range)
+    if not bins:
+        print("❌ Histograma vacío: revise el rango de magnitudes")
+        raise SystemExit(1)
+
+    plan = {"release": args.release, "range": args.range, "step": args.step,
+            "n_bins": args.n_bins, "max_per_tile": args.max_per_tile, "total": total,
+            "histogram": os.path.abspath(cache_path),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "bins": bins}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(plan, f, indent=1)
+
+    print(f"\n{len(bins)} bins para {total} objetos (media {total / len(bins):.0f} por bin):")
+    for i, b in enumerate(bins, start=1):
+        print(f"  Bin {i}: {b['lo']:>6} ≤ i < {b['hi']:<6} {b['count']:>10}  "
+              f"(máx. por tile {b['max_tile_count']})")
+    print(f"📄 {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Eliminación de detecciones duplicadas en tiles solapados (hash join espacial)
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, pandas, scipy
+
+Los tiles de JPAS se solapan y una misma fuente puede aparecer (y ser
+seleccionada) en varios `tile_id`. Cada detección se asigna a una celda
+de una rejilla 3-D sobre los vectores unitarios, de lado igual al radio
+de búsqueda; los pares candidatos salen de un join ordenado por clave de
+celda con las 27 celdas vecinas (sin distancias entre todos los pares ni
+problemas en RA = 0/360 o en los polos). Los pares dentro del radio se
+agrupan por componentes conexas; un grupo con varias filas del mismo tile
+(cadenas de pares entre fuentes vecinas) se rehace uniendo los pares de
+menor a mayor distancia sin repetir tile. De cada grupo se queda la mejor
+detección: menos flags y, a igualdad, menor error en J0660 (mayor SNR).
+
+Varias tablas de entrada (p. ej. los bins de magnitud) se unen antes de
+buscar duplicados, de modo que también se detectan entre tablas.
+
+Ejemplos:
+    python Jpas_dedup.py ../Halpha_emitters/Halpha_17_185.parquet --radius 1.0
+    python Jpas_dedup.py ../Halpha_emitters/Halpha_bin_*.parquet -o ../Halpha_emitters/Halpha_dedup.parquet
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from Jpas_index import radec_to_xyz, arcsec_to_chord
+from Jpas_io import read_table, write_table
+
+# Lado mínimo de celda: las claves (ix, iy, iz) se empaquetan en un int64
+MIN_CELL = 2.0 / 2**20
+FLAG_COLUMNS = ["flags_j0660", "flags_isdss", "mask_j0660", "mask_isdss"]
+
+
+def cell_keys(xyz, cell):
+    """Clave entera de celda de cada punto y desplazamientos de clave a las 27 vecinas"""
+    half = int(np.ceil(1.0 / cell)) + 2
+    side = 2 * half + 1
+    ijk = np.floor(xyz / cell).astype(np.int64) + half
+    keys = (ijk[:, 0] * side + ijk[:, 1]) * side + ijk[:, 2]
+    offsets = np.array([(dx * side + dy) * side + dz
+                        for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)],
+                       dtype=np.int64)
+    return keys, offsets
+
+
+def _pairs_block(rows, keys, order, sorted_keys, offsets, xyz, chord2, tiles):
+    """Pares (i, j), i < j, a menos de la cuerda `chord2` para las filas `rows`"""
+    out_i, out_j = [], []
+    for off in offsets:
+        target = keys[rows] + off
+        lo = np.searchsorted(sorted_keys, target, side="left")
+        hi = np.searchsorted(sorted_keys, target, side="right")
+        counts = hi - lo
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        i = np.repeat(rows, counts)
+        j = order[first + np.arange(total)]
+        keep = i < j
+        i, j = i[keep], j[keep]
+        d2 = ((xyz[i] - xyz[j])**2).sum(axis=1)
+        keep = d2 <= chord2
+        if tiles is not None:
+            keep &= tiles[i] != tiles[j]
+        out_i.append(i[keep])
+        out_j.append(j[keep])
+    if not out_i:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(out_i), np.concatenate(out_j)
+
+
+def split_shared_tiles(labels, i, j, xyz, tiles):
+    """Rehace los grupos con más de una fila de un mismo tile
+
+    Dentro de esos grupos los pares se unen de menor a mayor distancia y
+    sólo si los dos subgrupos no comparten tile, así cada grupo final
+    tiene como mucho una detección por tile.
+    """
+    _, tile_codes = np.unique(tiles, return_inverse=True)
+    group_tile = labels.astype(np.int64) * (int(tile_codes.max()) + 1) + tile_codes
+    values, counts = np.unique(group_tile, return_counts=True)
+    shared = np.isin(labels, np.unique(values[counts > 1] // (int(tile_codes.max()) + 1)))
+    if not shared.any():
+        return labels
+
+    pairs = shared[i]
+    i, j = i[pairs], j[pairs]
+    d2 = ((xyz[i] - xyz[j])**2).sum(axis=1)
+    parent = {r: r for r in np.flatnonzero(shared).tolist()}
+    members = {r: {int(tile_codes[r])} for r in parent}
+
+    def find(r):
+        while parent[r] != r:
+            parent[r] = parent[parent[r]]
+            r = parent[r]
+        return r
+
+    for k in np.argsort(d2, kind="stable"):
+        a, b = find(int(i[k])), find(int(j[k]))
+        if a == b or members[a] & members[b]:
+            continue
+        parent[b] = a
+        members[a] |= members.pop(b)
+
+    rows = np.flatnonzero(shared)
+    new = labels.astype(np.int64)
+    new[rows] = labels.max() + 1 + np.array([find(r) for r in rows.tolist()])
+    return np.unique(new, return_inverse=True)[1]
+
+
+def duplicate_groups(ra, dec, radius_arcsec=1.0, tiles=None, chunk_size=200000, workers=None):
+    """Etiqueta de grupo y número de detecciones por grupo para cada fila
+
+    Si se da `tiles`, sólo se unen detecciones de tiles distintos (los pares
+    cercanos dentro de un mismo tile son fuentes distintas deblendeadas) y
+    ningún grupo contiene dos filas del mismo tile.
+    """
+    xyz = radec_to_xyz(ra, dec)
+    chord = float(arcsec_to_chord(radius_arcsec))
+    keys, offsets = cell_keys(xyz, max(chord, MIN_CELL))
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    tiles = None if tiles is None else np.asarray(tiles)
+
+    def run(start):
+        rows = np.arange(start, min(start + chunk_size, len(keys)))
+        return _pairs_block(rows, keys, order, sorted_keys, offsets, xyz, chord**2, tiles)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, range(0, len(keys), chunk_size)))
+
+    i = np.concatenate([r[0] for r in results]) if results else np.empty(0, np.int64)
+    j = np.concatenate([r[1] for r in results]) if results else np.empty(0, np.int64)
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(len(keys), len(keys)))
+    _, labels = connected_components(graph, directed=False)
+    if tiles is not None and len(i):
+        labels = split_shared_tiles(labels, i, j, xyz, tiles)
+    n_detections = np.bincount(labels)[labels]
+    return labels, n_detections, len(i)
+
+
+def rank_detections(df, snr_band="J0660"):
+    """Orden de preferencia dentro de un grupo: flags (suma) y error en `snr_band`"""
+    flags = np.zeros(len(df))
+    for col in FLAG_COLUMNS:
+        if col in df.columns:
+            flags += df[col].fillna(0).to_numpy(dtype=np.float64)
+    err_col = f"err_{snr_band.lower()}_cor"
+    err = df[err_col].to_numpy(dtype=np.float64) if err_col in df.columns else np.zeros(len(df))
+    err = np.where(np.isfinite(err) & (err > 0), err, np.inf)
+    return np.lexsort((err, flags))
+
+
+def deduplicate(df, radius_arcsec=1.0, any_tile=False, snr_band="J0660", keep_all=False,
+                chunk_size=200000, workers=None):
+    """Devuelve `df` sin duplicados (o con is_primary si keep_all)
+
+    Añade dup_group y n_detections; la detección primaria de cada grupo es
+    la primera según rank_detections.
+    """
+    tiles = None if any_tile or "tile_id" not in df.columns else df["tile_id"].to_numpy()
+    labels, n_det, n_pairs = duplicate_groups(df["alpha_j2000"].to_numpy(),
+                                              df["delta_j2000"].to_numpy(),
+                                              radius_arcsec, tiles, chunk_size, workers)
+    rank = np.empty(len(df), dtype=np.int64)
+    rank[rank_detections(df, snr_band)] = np.arange(len(df))
+    # Primaria = la de menor rango de su grupo
+    best_rank = np.full(labels.max() + 1 if len(labels) else 0, np.iinfo(np.int64).max)
+    np.minimum.at(best_rank, labels, rank)
+    primary = rank == best_rank[labels]
+
+    out = df.copy()
+    out["dup_group"] = labels
+    out["n_detections"] = n_det
+    if keep_all:
+        out["is_primary"] = primary
+        return out, n_pairs
+    return out[primary], n_pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Elimina detecciones duplicadas de tiles solapados (hash join espacial)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", nargs="+",
+                        help="Tablas de candidatos (CSV/Parquet/FITS); varias se unen")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Salida (por defecto <entrada>_dedup con la misma extensión; "
+                             "obligatoria con varias entradas)")
+    parser.add_argument("--radius", type=float, default=1.0,
+                        help="Radio de coincidencia en arcsec")
+    parser.add_argument("--snr_band", default="J0660",
+                        help="Filtro cuyo error decide la mejor detección (tras los flags)")
+    parser.add_argument("--any_tile", action="store_true",
+                        help="Unir también detecciones cercanas del mismo tile")
+    parser.add_argument("--keep_all", action="store_true",
+                        help="Guardar todas las filas con la columna is_primary")
+    parser.add_argument("--chunk_size", type=int, default=200000,
+                        help="Filas por bloque del join")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Hilos (por defecto, los de ThreadPoolExecutor)")
+
+    args = parser.parse_args()
+    paths = sorted({p for pattern in args.input for p in (glob.glob(pattern) or [pattern])})
+    if len(paths) > 1 and not args.output:
+        print("❌ Con varias tablas de entrada hay que indicar -o/--output")
+        raise SystemExit(1)
+
+    print(f"\nCargando datos desde: {', '.join(paths)}")
+    df = pd.concat([read_table(p) for p in paths], ignore_index=True)
+    result, n_pairs = deduplicate(df, args.radius, args.any_tile, args.snr_band,
+                                  args.keep_all, args.chunk_size, args.workers)
+    primaries = result[result["is_primary"]] if args.keep_all else result
+    n_groups = int((primaries["n_detections"] > 1).sum())
+    n_unique = len(primaries)
+    print(f"Pares a menos de {args.radius}\": {n_pairs}; fuentes con varias detecciones: {n_groups}")
+    print(f"{len(df)} detecciones → {n_unique} fuentes únicas")
+
+    stem, ext = os.path.splitext(paths[0])
+    output = args.output or f"{stem}_dedup{ext}"
+    write_table(result, output)
+    print(f"\n✅ {len(result)} objetos guardados en:")
+    print(f"📄 {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Diagrama color-color (pseudo-r − iSDSS, pseudo-r − J0660) como mapa de densidad
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, pandas, matplotlib
+
+En lugar de `plt.scatter` sobre millones de puntos, los colores se
+acumulan por bloques en una rejilla 2-D fija (memoria constante, una sola
+pasada vectorizada por bloque). Encima se dibujan los loci ajustados por
+tile (uno por bin de magnitud y tile), la cota sigma_threshold·σ_int y
+los candidatos como puntos. La cota sólo usa la dispersión intrínseca: el
+umbral real de cada objeto suma además sus errores fotométricos y queda
+por encima de ella.
+
+Ejemplo:
+    python Jpas_density.py ../Data/jpas_bin_*.fits -c ../Halpha_emitters/Halpha_all.parquet \\
+        -o ../Plots/color_color_density.png --sigma_threshold 5
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+from Jpas_io import iter_table_chunks, read_table
+from Selecting_halpha import R_BANDS, R_ERRORS, apply_quality_cuts, compute_colors
+
+# Configuración de estilo
+plt.rcParams['font.family'] = 'DejaVu Sans'
+plt.rcParams['axes.labelsize'] = 14
+plt.rcParams['axes.titlesize'] = 12
+
+COLOR_COLUMNS = (R_BANDS + R_ERRORS +
+                 ['mag_isdss_cor', 'err_isdss_cor', 'mag_j0660_cor', 'err_j0660_cor',
+                  'flags_j0660', 'mask_j0660', 'flags_isdss', 'mask_isdss'])
+
+
+class DensityGrid:
+    """Histograma 2-D acumulable por bloques"""
+
+    def __init__(self, xlim, ylim, bins):
+        self.xlim, self.ylim = xlim, ylim
+        self.nx, self.ny = bins
+        self.counts = np.zeros(self.nx * self.ny, dtype=np.int64)
+        self.n_total = 0
+        self.n_outside = 0
+
+    def add(self, x, y):
+        """Acumula un bloque de puntos (un único bincount vectorizado)"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        ix = np.floor((x - self.xlim[0]) / (self.xlim[1] - self.xlim[0]) * self.nx)
+        iy = np.floor((y - self.ylim[0]) / (self.ylim[1] - self.ylim[0]) * self.ny)
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        flat = iy[inside].astype(np.int64) * self.nx + ix[inside].astype(np.int64)
+        self.counts += np.bincount(flat, minlength=self.nx * self.ny)
+        self.n_total += len(x)
+        self.n_outside += int((~inside).sum())
+
+    @property
+    def image(self):
+        return self.counts.reshape(self.ny, self.nx)
+
+
+def accumulate(paths, grid, chunk_rows=500000, quality=True):
+    """Recorre los catálogos por bloques y acumula sus colores en la rejilla"""
+    for path in paths:
+        for chunk in iter_table_chunks(path, COLOR_COLUMNS, chunk_rows):
+            if quality:
+                chunk = apply_quality_cuts(chunk)
+            chunk = compute_colors(chunk.copy())
+            grid.add(chunk['color_x'].values, chunk['color_y'].values)
+    return grid
+
+
+def tile_loci(candidates):
+    """Pendiente, ordenada y dispersión intrínseca de cada locus de la tabla de candidatos
+
+    Una tabla unida de varios bins trae un locus por (bin, tile): se
+    distinguen por sus parámetros, no sólo por tile_id.
+    """
+    cols = ['tile_id', 'slope', 'intercept', 'sigma_int']
+    if not set(cols).issubset(candidates.columns):
+        return pd.DataFrame(columns=cols)
+    return candidates[cols].drop_duplicates()
+
+
+def render(grid, output, candidates=None, sigma_threshold=5.0, max_loci=200, title=None):
+    """Dibuja el mapa de densidad con loci, umbrales y candidatos"""
+    fig, ax = plt.subplots(figsize=(10, 8))
+    ax.spines[["top", "right"]].set_visible(False)
+    image = np.ma.masked_equal(grid.image, 0)
+    extent = [grid.xlim[0], grid.xlim[1], grid.ylim[0], grid.ylim[1]]
+    if image.count():
+        im = ax.imshow(image, origin='lower', extent=extent, aspect='auto',
+                       cmap='Greys', norm=LogNorm(vmin=1, vmax=max(image.max(), 2)),
+                       interpolation='nearest')
+        fig.colorbar(im, ax=ax, label='Objetos por celda')
+
+    if candidates is not None and len(candidates):
+        loci = tile_loci(candidates)
+        xs = np.array(grid.xlim)
+        for _, row in loci.head(max_loci).iterrows():
+            locus = row['intercept'] + row['slope'] * xs
+            ax.plot(xs, locus, color='tab:blue', lw=0.5, alpha=0.4)
+            ax.plot(xs, locus + sigma_threshold * row['sigma_int'],
+                    color='tab:red', lw=0.5, ls='--', alpha=0.4)
+        if len(loci):
+            m, b = loci['slope'].median(), loci['intercept'].median()
+            s = loci['sigma_int'].median()
+            ax.plot(xs, b + m * xs, color='tab:blue', lw=2, label='Locus (mediana de loci)')
+            ax.plot(xs, b + m * xs + sigma_threshold * s, color='tab:red', lw=2, ls='--',
+                    label=f'Cota {sigma_threshold:g}·σ_int (sin errores por objeto)')
+        ax.scatter(candidates['color_x'], candidates['color_y'], s=8, c='tab:orange',
+                   edgecolors='k', linewidths=0.3, label=f'Candidatos ({len(candidates)})',
+                   zorder=3)
+        ax.legend(loc='upper left', fontsize=10)
+
+    ax.set_xlim(grid.xlim)
+    ax.set_ylim(grid.ylim)
+    ax.set_xlabel(r"$(r_{\rm pseudo} - i_{\rm SDSS})$")
+    ax.set_ylabel(r"$(r_{\rm pseudo} - J0660)$")
+    ax.set_title(title or f"JPAS: {grid.n_total - grid.n_outside} objetos", pad=15)
+    plt.tight_layout()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    plt.savefig(output, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Diagrama color-color JPAS como mapa de densidad escalable",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("inputs", nargs="+", help="Catálogos (FITS/Parquet/CSV)")
+    parser.add_argument("-c", "--candidates", default=None,
+                        help="Tabla de candidatos de Selecting_halpha.py (loci + puntos)")
+    parser.add_argument("-o", "--output", default="./color_color_density.png",
+                        help="Imagen de salida")
+    parser.add_argument("--xlim", type=float, nargs=2, default=[-1.5, 2.5])
+    parser.add_argument("--ylim", type=float, nargs=2, default=[-1.0, 3.0])
+    parser.add_argument("--bins", type=int, nargs=2, default=[400, 400],
+                        help="Celdas en x e y")
+    parser.add_argument("--chunk_rows", type=int, default=500000,
+                        help="Filas por bloque")
+    parser.add_argument("--sigma_threshold", type=float, default=5.0,
+                        help="Múltiplo de σ_int de las cotas dibujadas (sin errores por objeto)")
+    parser.add_argument("--max_loci", type=int, default=200,
+                        help="Máximo de loci individuales dibujados")
+    parser.add_argument("--no_quality", action="store_true",
+                        help="No aplicar los filtros de calidad")
+
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+
+    grid = DensityGrid(tuple(args.xlim), tuple(args.ylim), tuple(args.bins))
+    accumulate(args.inputs, grid, args.chunk_rows, quality=not args.no_quality)
+    print(f"{grid.n_total} objetos acumulados ({grid.n_outside} fuera de los límites)")
+
+    candidates = read_table(args.candidates) if args.candidates else None
+    render(grid, args.output, candidates, args.sigma_threshold, args.max_loci)
+    print(f"\n✅ Diagrama generado en {time.perf_counter() - t0:.2f} s")
+    print(f"📄 {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Flujo de línea y anchura equivalente de Hα (J0660) para todos los objetos
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, pandas
+
+El continuo en J0660 se estima con un ajuste lineal ponderado (en flujo
+vs. longitud de onda) a los filtros J06xx vecinos; luego, con la anchura
+de J0660 de JPAS-filters.csv:
+
+    F(Hα)  = W_J0660 · (f_J0660 − f_cont)
+    EW(Hα) = W_J0660 · (f_J0660 / f_cont − 1)
+
+Todo se calcula en una sola pasada de NumPy (por bloques de filas).
+
+El continuo debe rodear a Hα: se exigen al menos --min_per_side filtros
+presentes a cada lado de J0660, y ninguno puede contener Hα en su banda
+(J0650, 6428–6572 Å, queda fuera). Los bins de JPAS-data-v2.py sólo traen
+J0600–J0650 (lado azul); con ellos hay que pedir --extrapolate de forma
+explícita, o descargar con JPAS-data-allFilter.py (J0670–J0700).
+
+Ejemplo:
+    python Jpas_halpha_ew.py ../Halpha_emitters/Halpha_17_185.parquet -f ../JPAS-filters.csv --ew_min 20
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from Jpas_io import read_table, write_table
+from Jpas_SED import mag_to_flux
+
+LINE_FILTER = "J0660"
+HALPHA_WAVELENGTH = 6562.8  # Å, en reposo
+# J0650 contiene Hα en su banda: no sirve de continuo
+CONTINUUM_BLUE = ["J0600", "J0610", "J0620", "J0630", "J0640"]
+CONTINUUM_RED = ["J0670", "J0680", "J0690", "J0700"]
+DEFAULT_CONTINUUM = CONTINUUM_BLUE + CONTINUUM_RED
+BAD_MAG = 90.0  # JPAS usa 99 para no detecciones
+
+
+def load_filters(filter_file):
+    """Longitud de onda y anchura de cada filtro indexadas por nombre"""
+    filters = pd.read_csv(filter_file)
+    filters['wavelength'] = pd.to_numeric(filters['wavelength'], errors='coerce')
+    filters['width'] = pd.to_numeric(filters['width'], errors='coerce')
+    return filters.set_index(filters['name'].str.strip())[['wavelength', 'width']]
+
+
+def continuum_sides(bands, filters):
+    """Filtros de continuo a cada lado (azul, rojo) de J0660"""
+    lam_line = filters.loc[LINE_FILTER, 'wavelength']
+    blue = [b for b in bands if filters.loc[b, 'wavelength'] < lam_line]
+    red = [b for b in bands if filters.loc[b, 'wavelength'] > lam_line]
+    return blue, red
+
+
+def contains_halpha(bands, filters):
+    """Filtros de `bands` cuya banda contiene Hα en reposo"""
+    return [b for b in bands
+            if abs(HALPHA_WAVELENGTH - filters.loc[b, 'wavelength']) <= filters.loc[b, 'width'] / 2]
+
+
+def _band_arrays(df, bands):
+    """Matrices (N, B) de magnitudes y errores; NaN para valores no válidos"""
+    mags = df[[f"mag_{b.lower()}_cor" for b in bands]].to_numpy(dtype=np.float64, copy=True)
+    errs = df[[f"err_{b.lower()}_cor" for b in bands]].to_numpy(dtype=np.float64, copy=True)
+    bad = ~np.isfinite(mags) | ~np.isfinite(errs) | (mags >= BAD_MAG) | (errs <= 0)
+    mags[bad] = np.nan
+    errs[bad] = np.nan
+    return mags, errs
+
+
+def continuum_at(flux, flux_err, wavelengths, lambda0):
+    """Ajuste lineal ponderado f(λ) por fila, evaluado en lambda0
+
+    Con menos de dos puntos válidos se usa la media ponderada.
+    Devuelve (continuo, error) con forma (N,).
+    """
+    w = np.where(np.isfinite(flux), 1.0 / flux_err**2, 0.0)
+    y = np.where(np.isfinite(flux), flux, 0.0)
+    x = (wavelengths - lambda0)[None, :]
+    S, Sx, Sxx = w.sum(1), (w * x).sum(1), (w * x**2).sum(1)
+    Sy, Sxy = (w * y).sum(1), (w * x * y).sum(1)
+    delta = S * Sxx - Sx**2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n_valid = (w > 0).sum(1)
+        linear = (n_valid >= 2) & (delta > 0)
+        cont = np.where(linear, (Sxx * Sy - Sx * Sxy) / delta, Sy / S)
+        var = np.where(linear, Sxx / delta, 1.0 / S)
+    cont[n_valid == 0] = np.nan
+    return cont, np.sqrt(var)
+
+
+def measure_halpha(df, filters, continuum_bands=DEFAULT_CONTINUUM, zp=2.41):
+    """Columnas de continuo, flujo de línea, EW y errores para todas las filas de `df`"""
+    lam_line, width = filters.loc[LINE_FILTER, 'wavelength'], filters.loc[LINE_FILTER, 'width']
+    lam_cont = filters.loc[continuum_bands, 'wavelength'].to_numpy(dtype=np.float64)
+
+    line_mag, line_err = _band_arrays(df, [LINE_FILTER])
+    f_line, e_line = mag_to_flux(line_mag[:, 0], line_err[:, 0], lam_line, zp)
+    cont_mag, cont_err = _band_arrays(df, continuum_bands)
+    f_cont, e_cont = mag_to_flux(cont_mag, cont_err, lam_cont[None, :], zp)
+    cont, e_cont_fit = continuum_at(f_cont, e_cont, lam_cont, lam_line)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = f_line / cont
+        line_flux = width * (f_line - cont)
+        e_line_flux = width * np.sqrt(e_line**2 + e_cont_fit**2)
+        ew = width * (ratio - 1.0)
+        e_ew = width * np.abs(ratio) * np.sqrt((e_line / f_line)**2 + (e_cont_fit / cont)**2)
+
+    return pd.DataFrame({
+        "cont_j0660": cont,
+        "e_cont_j0660": e_cont_fit,
+        "flux_halpha": line_flux,
+        "e_flux_halpha": e_line_flux,
+        "ew_halpha": ew,
+        "e_ew_halpha": e_ew,
+        "snr_halpha": line_flux / e_line_flux,
+    }, index=df.index)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Flujo de línea y EW de Hα (J0660) con continuo de filtros J06xx vecinos",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", help="Candidatos de Selecting_halpha.py o bin FITS completo")
+    parser.add_argument("-f", "--filters", default="../JPAS-filters.csv",
+                        help="Archivo CSV de definición de filtros (wavelength, width)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Salida (por defecto <entrada>_ew con la misma extensión)")
+    parser.add_argument("--continuum", nargs="+", default=DEFAULT_CONTINUUM,
+                        help="Filtros de continuo (se usan los presentes en la tabla)")
+    parser.add_argument("--min_per_side", type=int, default=2,
+                        help="Filtros de continuo presentes exigidos a cada lado de J0660")
+    parser.add_argument("--extrapolate", action="store_true",
+                        help="Permitir un continuo con menos filtros por lado (extrapolado)")
+    parser.add_argument("--zp", type=float, default=2.41,
+                        help="Zero point para conversión de magnitud")
+    parser.add_argument("--ew_min", type=float, default=20.0,
+                        help="EW(Hα) mínima en Å para la columna ew_pass")
+    parser.add_argument("--only_pass", action="store_true",
+                        help="Guardar sólo los objetos con EW(Hα) >= ew_min")
+    parser.add_argument("--chunk_size", type=int, default=1000000,
+                        help="Filas por bloque")
+
+    args = parser.parse_args()
+
+    print(f"\nCargando datos desde: {args.input}")
+    df = read_table(args.input)
+    filters = load_filters(args.filters)
+
+    bands = [b for b in args.continuum
+             if f"mag_{b.lower()}_cor" in df.columns and b in filters.index]
+    with_line = contains_halpha(bands, filters)
+    if with_line:
+        print(f"⚠️ Se descartan del continuo (contienen Hα): {', '.join(with_line)}")
+        bands = [b for b in bands if b not in with_line]
+    if not bands:
+        print("❌ Ningún filtro de continuo disponible en la tabla")
+        raise SystemExit(1)
+    blue, red = continuum_sides(bands, filters)
+    if min(len(blue), len(red)) < args.min_per_side:
+        message = (f"continuo con {len(blue)} filtros en el lado azul y {len(red)} en el rojo "
+                   f"de {LINE_FILTER} (mínimo {args.min_per_side} por lado)")
+        if not args.extrapolate:
+            print(f"❌ Continuo insuficiente: {message}")
+            print("Descargue con JPAS-data-allFilter.py (J0670–J0700) o use --extrapolate")
+            raise SystemExit(1)
+        print(f"⚠️ Continuo extrapolado: {message}")
+    print(f"Continuo con: {', '.join(bands)}")
+
+    parts = [measure_halpha(df.iloc[i:i + args.chunk_size], filters, bands, args.zp)
+             for i in range(0, len(df), args.chunk_size)]
+    measures = pd.concat(parts) if parts else measure_halpha(df, filters, bands, args.zp)
+    result = pd.concat([df, measures], axis=1)
+    result["ew_pass"] = result["ew_halpha"] >= args.ew_min
+
+    n_pass = int(result["ew_pass"].sum())
+    print(f"EW(Hα) >= {args.ew_min} Å: {n_pass} de {len(result)} objetos")
+    if args.only_pass:
+        result = result[result["ew_pass"]]
+
+    stem, ext = os.path.splitext(args.input)
+    output = args.output or f"{stem}_ew{ext}"
+    write_table(result, output)
+    print(f"\n✅ {len(result)} objetos guardados en:")
+    print(f"📄 {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
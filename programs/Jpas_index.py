@@ -0,0 +1,381 @@
+"""
+Índice espacial persistente sobre el catálogo JPAS local (Data/jpas_bin_*.fits|.shards)
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, scipy
+
+Construye un k-d tree por cada shard (bin FITS o directorio .shards de
+Jpas_io) sobre vectores unitarios en la esfera y permite búsquedas de
+cono, de caja y de vecinos más cercanos.
+El índice se guarda en disco y sólo se reconstruyen los shards nuevos o
+modificados.
+
+Ejemplos:
+    python Jpas_index.py build ../Data
+    python Jpas_index.py cone ../Data 150.1 2.2 --radius 5
+    python Jpas_index.py box ../Data 149.9 150.3 2.0 2.4
+    python Jpas_index.py nearest ../Data 150.1 2.2 -k 3
+    python Jpas_index.py check
+"""
+
+import argparse
+import glob
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+from Jpas_io import SHARDS_EXT, SHARD_MANIFEST, load_shard_manifest, read_sharded
+
+INDEX_DIRNAME = "index"
+MANIFEST_NAME = "manifest.json"
+SHARD_PATTERNS = ["jpas_bin_*.fits", "jpas_bin_*" + SHARDS_EXT]
+INDEX_COLUMNS = ["alpha_j2000", "delta_j2000", "number", "tile_id"]
+
+
+def radec_to_xyz(ra, dec):
+    """Convierte (RA, Dec) en grados a vectores unitarios (N, 3)"""
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+def arcsec_to_chord(radius_arcsec):
+    """Convierte un radio angular (arcsec) a distancia de cuerda en la esfera unidad"""
+    return 2.0 * np.sin(np.radians(np.asarray(radius_arcsec) / 3600.0) / 2.0)
+
+
+def chord_to_arcsec(chord):
+    """Convierte distancia de cuerda a separación angular (arcsec)"""
+    return np.degrees(2.0 * np.arcsin(np.clip(np.asarray(chord) / 2.0, 0.0, 1.0))) * 3600.0
+
+
+def _shard_signature(path):
+    """Firma barata (tamaño + mtime) para detectar shards nuevos o modificados
+
+    Para un directorio .shards se usa su manifiesto, que se reescribe (al
+    final) cada vez que cambian las partes.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, SHARD_MANIFEST)
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+
+def _native(arr):
+    """Copia en el orden de bytes nativo (FITS es big-endian; pandas no lo ordena)"""
+    arr = np.asarray(arr)
+    return arr.astype(arr.dtype.newbyteorder("="))
+
+
+def _read_shard_columns(path):
+    """Lee sólo las columnas necesarias para el índice desde un FITS o un .shards"""
+    if os.path.isdir(path):
+        available = {n.lower(): n for n in load_shard_manifest(path)["columns"]}
+        df = read_sharded(path, columns=[available[c] for c in INDEX_COLUMNS if c in available])
+        data = {c.lower(): df[c].to_numpy() for c in df.columns}
+    else:
+        with fits.open(path, memmap=True) as hdul:
+            table = hdul[1].data
+            data = {n.lower(): _native(table[n]) for n in table.columns.names
+                    if n.lower() in INDEX_COLUMNS}
+    ra = np.asarray(data["alpha_j2000"], dtype=np.float64)
+    dec = np.asarray(data["delta_j2000"], dtype=np.float64)
+    number = _native(data["number"]) if "number" in data else np.arange(len(ra))
+    tile_id = _native(data["tile_id"]) if "tile_id" in data else np.full(len(ra), -1)
+    return ra, dec, number, tile_id
+
+
+class CatalogIndex:
+    """Índice espacial del almacén local de catálogos, un k-d tree por shard"""
+
+    def __init__(self, data_dir, pattern=SHARD_PATTERNS, index_dir=None):
+        self.data_dir = data_dir
+        self.patterns = [pattern] if isinstance(pattern, str) else list(pattern)
+        self.index_dir = index_dir or os.path.join(data_dir, INDEX_DIRNAME)
+        self.manifest_path = os.path.join(self.index_dir, MANIFEST_NAME)
+        self.shards = {}
+
+    # ------------------------------------------------------------------
+    # Construcción / actualización
+    # ------------------------------------------------------------------
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_manifest(self, manifest):
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def _shard_index_path(self, shard_name):
+        # Un bin .fits y su versión .shards no comparten fichero de índice
+        stem = shard_name if shard_name.endswith(SHARDS_EXT) else os.path.splitext(shard_name)[0]
+        return os.path.join(self.index_dir, stem + ".idx.pkl")
+
+    def _current_shards(self):
+        """Shards presentes en el directorio de datos (sólo .shards con manifiesto)"""
+        paths = set()
+        for pattern in self.patterns:
+            paths.update(glob.glob(os.path.join(self.data_dir, pattern)))
+        return sorted(p for p in paths
+                      if not os.path.isdir(p) or os.path.isfile(os.path.join(p, SHARD_MANIFEST)))
+
+    def update(self, verbose=True):
+        """Reconstruye sólo los shards nuevos/modificados y elimina los borrados"""
+        os.makedirs(self.index_dir, exist_ok=True)
+        manifest = self._load_manifest()
+        current = self._current_shards()
+        current_names = {os.path.basename(p): p for p in current}
+
+        rebuilt, removed = [], []
+        for name in list(manifest):
+            if name not in current_names:
+                idx_path = self._shard_index_path(name)
+                if os.path.exists(idx_path):
+                    os.remove(idx_path)
+                del manifest[name]
+                removed.append(name)
+
+        for name, path in current_names.items():
+            sig = _shard_signature(path)
+            idx_path = self._shard_index_path(name)
+            if manifest.get(name) == sig and os.path.exists(idx_path):
+                continue
+            ra, dec, number, tile_id = _read_shard_columns(path)
+            shard = {
+                "tree": cKDTree(radec_to_xyz(ra, dec)),
+                "ra": ra,
+                "dec": dec,
+                "number": number,
+                "tile_id": tile_id,
+            }
+            with open(idx_path, "wb") as f:
+                pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+            manifest[name] = sig
+            rebuilt.append(name)
+
+        self._save_manifest(manifest)
+        self.shards = {}
+        if verbose:
+            print(f"Índice actualizado: {len(rebuilt)} shards reconstruidos, "
+                  f"{len(removed)} eliminados, {len(manifest)} en total")
+        return rebuilt
+
+    def load(self, update=True):
+        """Carga el índice en memoria (actualizándolo antes si se pide)"""
+        if update:
+            self.update(verbose=False)
+        manifest = self._load_manifest()
+        for name in manifest:
+            if name not in self.shards:
+                with open(self._shard_index_path(name), "rb") as f:
+                    self.shards[name] = pickle.load(f)
+        return self
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _rows(shard_name, shard, idx, sep_arcsec=None):
+        out = pd.DataFrame({
+            "shard": shard_name,
+            "row": idx,
+            "number": shard["number"][idx],
+            "tile_id": shard["tile_id"][idx],
+            "alpha_j2000": shard["ra"][idx],
+            "delta_j2000": shard["dec"][idx],
+        })
+        if sep_arcsec is not None:
+            out["sep_arcsec"] = sep_arcsec
+        return out
+
+    def _concat(self, parts, sort_by=None):
+        columns = ["shard", "row", "number", "tile_id", "alpha_j2000", "delta_j2000"]
+        if sort_by:
+            columns.append(sort_by)
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        out = pd.concat(parts, ignore_index=True)
+        if sort_by:
+            out = out.sort_values(sort_by, ignore_index=True)
+        return out
+
+    def cone(self, ra, dec, radius_arcsec):
+        """Objetos dentro de un cono de radio `radius_arcsec` alrededor de (ra, dec)"""
+        center = radec_to_xyz([ra], [dec])[0]
+        chord = float(arcsec_to_chord(radius_arcsec))
+        parts = []
+        for name, shard in self.shards.items():
+            idx = np.asarray(shard["tree"].query_ball_point(center, chord), dtype=np.int64)
+            if idx.size == 0:
+                continue
+            d = np.linalg.norm(shard["tree"].data[idx] - center, axis=1)
+            parts.append(self._rows(name, shard, idx, chord_to_arcsec(d)))
+        return self._concat(parts, sort_by="sep_arcsec")
+
+    def box(self, ra_min, ra_max, dec_min, dec_max):
+        """Objetos dentro de una caja RA/Dec (admite cruce de RA=0 si ra_min > ra_max)
+
+        Un intervalo de 360° o más (p. ej. 0–360) se toma como todas las RA.
+        """
+        if ra_max - ra_min >= 360.0:
+            ra_min, ra_span = 0.0, 360.0
+        else:
+            ra_min, ra_max = ra_min % 360.0, ra_max % 360.0
+            ra_span = (ra_max - ra_min) % 360.0
+        ra_c = (ra_min + ra_span / 2.0) % 360.0
+        dec_c = (dec_min + dec_max) / 2.0
+        # Cono que circunscribe la caja; luego se filtra exactamente
+        corners = radec_to_xyz([ra_min, ra_min, ra_max, ra_max, ra_c, ra_c],
+                               [dec_min, dec_max, dec_min, dec_max, dec_min, dec_max])
+        center = radec_to_xyz([ra_c], [dec_c])[0]
+        chord = float(np.max(np.linalg.norm(corners - center, axis=1))) * (1 + 1e-9)
+        if ra_span >= 180.0:
+            # Las esquinas ya no acotan la caja: se filtra sobre todo el shard
+            chord = 2.0 + 1e-9
+        parts = []
+        for name, shard in self.shards.items():
+            idx = np.asarray(shard["tree"].query_ball_point(center, chord), dtype=np.int64)
+            if idx.size == 0:
+                continue
+            ra, dec = shard["ra"][idx], shard["dec"][idx]
+            inside = ((ra - ra_min) % 360.0 <= ra_span) & (dec >= dec_min) & (dec <= dec_max)
+            if inside.any():
+                parts.append(self._rows(name, shard, np.sort(idx[inside])))
+        return self._concat(parts)
+
+    def nearest(self, ra, dec, k=1, max_radius_arcsec=np.inf):
+        """Los `k` vecinos más cercanos a (ra, dec) en todo el almacén"""
+        center = radec_to_xyz([ra], [dec])[0]
+        bound = float(arcsec_to_chord(max_radius_arcsec)) if np.isfinite(max_radius_arcsec) else np.inf
+        parts = []
+        for name, shard in self.shards.items():
+            kk = min(k, shard["tree"].n)
+            if kk == 0:
+                continue
+            d, idx = shard["tree"].query(center, k=kk, distance_upper_bound=bound)
+            d, idx = np.atleast_1d(d), np.atleast_1d(idx)
+            ok = np.isfinite(d)
+            if ok.any():
+                parts.append(self._rows(name, shard, idx[ok], chord_to_arcsec(d[ok])))
+        return self._concat(parts, sort_by="sep_arcsec").head(k)
+
+
+def self_check(n=2000, seed=0):
+    """Comprueba cono, caja y vecinos contra fuerza bruta en shards sintéticos
+
+    Escribe un bin FITS (columnas big-endian, como las de la descarga) y el
+    mismo bin como .shards, construye el índice y compara los resultados.
+    """
+    from astropy.table import Table
+    from Jpas_io import write_sharded
+
+    rng = np.random.default_rng(seed)
+    ra0, dec0 = 150.1, 2.2
+    table = Table({
+        "number": np.arange(n, dtype=">i8"),
+        "tile_id": rng.integers(1000, 1004, n).astype(">i8"),
+        "alpha_j2000": (ra0 + rng.uniform(-0.02, 0.02, n)).astype(">f8"),
+        "delta_j2000": (dec0 + rng.uniform(-0.02, 0.02, n)).astype(">f8"),
+    })
+    xyz = radec_to_xyz(table["alpha_j2000"], table["delta_j2000"])
+    center = radec_to_xyz([ra0], [dec0])[0]
+    sep = chord_to_arcsec(np.linalg.norm(xyz - center, axis=1))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        table.write(os.path.join(tmp, "jpas_bin_1_13.0to16.0i.fits"), format="fits")
+        write_sharded(table, os.path.join(tmp, "jpas_bin_2_16.0to17.5i" + SHARDS_EXT),
+                      rows_per_part=n // 3)
+        # Cada tipo de shard por separado (un único FITS deja las columnas
+        # big-endian sin mezclar) y después los dos juntos
+        for k, patterns in enumerate(([SHARD_PATTERNS[0]], [SHARD_PATTERNS[1]], SHARD_PATTERNS)):
+            index = CatalogIndex(tmp, pattern=patterns, index_dir=os.path.join(tmp, f"index_{k}"))
+            index.load()
+            assert len(index.shards) == len(patterns), f"shards indexados: {sorted(index.shards)}"
+            for radius in (15.0, 30.0):
+                result = index.cone(ra0, dec0, radius)
+                expected = np.sort(np.flatnonzero(sep <= radius))
+                assert len(expected) >= 3, "cono sin resultados suficientes"
+                for name, part in result.groupby("shard"):
+                    assert np.array_equal(np.sort(part["number"].to_numpy()), expected), name
+                assert result["sep_arcsec"].is_monotonic_increasing
+            print(f"✅ cone 15\"/30\" ({', '.join(sorted(index.shards))}): "
+                  f"{len(expected)} objetos por shard")
+
+        full = index.box(0.0, 360.0, -90.0, 90.0)
+        assert len(full) == 2 * n, f"box 0–360: {len(full)} de {2 * n}"
+        near = index.nearest(ra0, dec0, k=5)
+        assert np.allclose(near["sep_arcsec"].to_numpy()[::2], np.sort(sep)[:3])
+        print(f"✅ box 0–360: {len(full)} objetos; nearest k=5 correcto")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Índice espacial (k-d tree) sobre los catálogos JPAS descargados",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--pattern", nargs="+", default=SHARD_PATTERNS,
+                        help="Patrones de los shards (FITS o .shards) dentro del directorio de datos")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="Construir/actualizar el índice")
+    p_build.add_argument("data_dir", help="Directorio con los shards FITS o .shards")
+
+    sub.add_parser("check", help="Autocomprobación con shards sintéticos")
+
+    p_cone = sub.add_parser("cone", help="Búsqueda de cono")
+    p_cone.add_argument("data_dir")
+    p_cone.add_argument("ra", type=float)
+    p_cone.add_argument("dec", type=float)
+    p_cone.add_argument("--radius", type=float, default=3.0, help="Radio en arcsec")
+
+    p_box = sub.add_parser("box", help="Búsqueda en caja RA/Dec")
+    p_box.add_argument("data_dir")
+    p_box.add_argument("ra_min", type=float)
+    p_box.add_argument("ra_max", type=float)
+    p_box.add_argument("dec_min", type=float)
+    p_box.add_argument("dec_max", type=float)
+
+    p_near = sub.add_parser("nearest", help="Vecinos más cercanos")
+    p_near.add_argument("data_dir")
+    p_near.add_argument("ra", type=float)
+    p_near.add_argument("dec", type=float)
+    p_near.add_argument("-k", type=int, default=1, help="Número de vecinos")
+
+    for p in (p_cone, p_box, p_near):
+        p.add_argument("-o", "--output", default=None, help="CSV de salida (opcional)")
+
+    args = parser.parse_args()
+    if args.command == "check":
+        self_check()
+        return
+    index = CatalogIndex(args.data_dir, pattern=args.pattern)
+
+    if args.command == "build":
+        index.update()
+        return
+
+    index.load()
+    if args.command == "cone":
+        result = index.cone(args.ra, args.dec, args.radius)
+    elif args.command == "box":
+        result = index.box(args.ra_min, args.ra_max, args.dec_min, args.dec_max)
+    else:
+        result = index.nearest(args.ra, args.dec, k=args.k)
+
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"{len(result)} objetos guardados en {args.output}")
+    else:
+        print(result.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
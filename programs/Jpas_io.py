@@ -0,0 +1,297 @@
+"""
+Lectura/escritura de tablas de candidatos JPAS (Parquet, FITS o CSV)
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, pandas (pyarrow para Parquet)
+
+El formato se deduce de la extensión:
+    .parquet / .pq  → Parquet (columnas tipadas, precisión completa, zstd)
+    .fits / .fit    → tabla binaria FITS (precisión completa)
+    .csv            → texto (compatibilidad con el flujo anterior)
+    .shards/        → directorio de partes comprimidas (part_NNNN.fits.gz o
+                      .parquet) + manifest.json, escritas y leídas en paralelo
+
+Exportación rápida a CSV bajo demanda:
+    python Jpas_io.py ../Halpha_emitters/Halpha_17_185.parquet -o Halpha_17_185.csv
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
+
+PARQUET_EXT = (".parquet", ".pq")
+FITS_EXT = (".fits", ".fit", ".fits.gz")
+SHARDS_EXT = ".shards"
+SHARD_MANIFEST = "manifest.json"
+SHARD_FORMATS = ("fits.gz", "parquet")
+
+# Formato histórico de los CSV de candidatos (redondea a 4 decimales)
+LEGACY_CSV_FLOAT_FORMAT = "%.4f"
+
+
+def table_format(path):
+    """Formato de una tabla según su extensión"""
+    name = path.lower().rstrip("/")
+    if name.endswith(SHARDS_EXT) or os.path.isfile(os.path.join(path, SHARD_MANIFEST)):
+        return "shards"
+    if name.endswith(PARQUET_EXT):
+        return "parquet"
+    if name.endswith(FITS_EXT):
+        return "fits"
+    return "csv"
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("❌ Parquet requiere pyarrow (pip install pyarrow)")
+        raise SystemExit(1)
+
+
+def read_table(path, columns=None):
+    """Carga una tabla CSV, FITS o Parquet como DataFrame"""
+    fmt = table_format(path)
+    if fmt == "shards":
+        return read_sharded(path, columns)
+    if fmt == "parquet":
+        _require_pyarrow()
+        return pd.read_parquet(path, columns=columns)
+    if fmt == "fits":
+        table = Table.read(path, hdu=1)
+        if columns is not None:
+            table = table[[c for c in table.colnames if c in columns]]
+        return table.to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def iter_table_chunks(path, columns=None, chunk_rows=500000):
+    """Lee una tabla por bloques de filas (memoria acotada por el tamaño del bloque)
+
+    FITS se lee con memmap y sólo se copian las columnas pedidas; Parquet
+    por lotes de pyarrow; CSV con el lector por bloques de pandas.
+    """
+    fmt = table_format(path)
+    if fmt == "shards":
+        # Una parte cada vez (su tamaño lo fija rows_per_part al escribir)
+        manifest = load_shard_manifest(path)
+        for part in manifest["parts"]:
+            yield _read_part(os.path.join(path, part["file"]), manifest["format"], columns)
+    elif fmt == "parquet":
+        _require_pyarrow()
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    elif fmt == "fits":
+        with fits.open(path, memmap=True) as hdul:
+            data = hdul[1].data
+            names = columns or list(data.columns.names)
+            for start in range(0, len(data), chunk_rows):
+                block = data[start:start + chunk_rows]
+                yield pd.DataFrame({
+                    name: np.asarray(block[name]).astype(block[name].dtype.newbyteorder("="))
+                    for name in names
+                })
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_rows)
+
+
+def load_shard_manifest(path):
+    """Manifiesto de una tabla particionada (formato, filas y partes en orden)"""
+    with open(os.path.join(path, SHARD_MANIFEST)) as f:
+        return json.load(f)
+
+
+def _write_part(block, path, part_format, compresslevel):
+    if part_format == "parquet":
+        block.to_pandas().to_parquet(path, index=False, compression="zstd")
+        return
+    # gzip fuera de astropy para fijar el nivel; zlib libera el GIL
+    buf = io.BytesIO()
+    block.write(buf, format="fits")
+    with open(path, "wb") as f:
+        f.write(gzip.compress(buf.getvalue(), compresslevel))
+
+
+def _read_part(path, part_format, columns=None):
+    if part_format == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    with open(path, "rb") as f:
+        data = gzip.decompress(f.read())
+    with fits.open(io.BytesIO(data)) as hdul:
+        table = Table(hdul[1].data)
+    if columns is not None:
+        table = table[[c for c in table.colnames if c in columns]]
+    return table.to_pandas()
+
+
+def write_sharded(table, path, rows_per_part=250000, part_format="fits.gz",
+                  compresslevel=3, workers=None):
+    """Escribe una tabla (astropy o DataFrame) en partes comprimidas en paralelo
+
+    Las partes se escriben con un pool de hilos y el manifiesto se escribe
+    al final, de modo que un lector nunca ve una tabla a medio escribir.
+    """
+    if part_format not in SHARD_FORMATS:
+        raise ValueError(f"Formato de parte no soportado: {part_format}")
+    if part_format == "parquet":
+        _require_pyarrow()
+    if isinstance(table, pd.DataFrame):
+        table = Table.from_pandas(table)
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.startswith("part_"):
+            os.remove(os.path.join(path, name))
+
+    starts = list(range(0, len(table), rows_per_part)) or [0]
+
+    def run(k):
+        block = table[starts[k]:starts[k] + rows_per_part]
+        name = f"part_{k:04d}.{part_format}"
+        _write_part(block, os.path.join(path, name), part_format, compresslevel)
+        return {"file": name, "rows": len(block)}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(run, range(len(starts))))
+
+    manifest = {"format": part_format, "rows": len(table), "columns": table.colnames,
+                "parts": parts}
+    tmp = os.path.join(path, SHARD_MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(path, SHARD_MANIFEST))
+    return manifest
+
+
+def read_sharded(path, columns=None, workers=None):
+    """Lee todas las partes en paralelo (pool de hilos) y las concatena en orden"""
+    manifest = load_shard_manifest(path)
+    if manifest["format"] == "parquet":
+        _require_pyarrow()
+    paths = [os.path.join(path, part["file"]) for part in manifest["parts"]]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(lambda p: _read_part(p, manifest["format"], columns), paths))
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_table(df, path, float_format=LEGACY_CSV_FLOAT_FORMAT):
+    """Guarda un DataFrame; Parquet y FITS conservan la precisión completa"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fmt = table_format(path)
+    if fmt == "shards":
+        write_sharded(df, path)
+        return
+    if fmt == "parquet":
+        _require_pyarrow()
+        df.to_parquet(path, index=False, compression="zstd")
+    elif fmt == "fits":
+        Table.from_pandas(df).write(path, overwrite=True, format="fits")
+    else:
+        df.to_csv(path, index=False, float_format=float_format, encoding='utf-8')
+
+
+class TableWriter:
+    """Escritura incremental de una tabla por bloques
+
+    Parquet añade un row group por bloque (pyarrow.ParquetWriter) y CSV
+    añade filas al mismo fichero; FITS no admite añadir filas a una tabla
+    binaria (ni .shards, que se reparte en partes al cerrar), así que
+    acumula los bloques y los escribe al cerrar.
+    """
+
+    def __init__(self, path, float_format=LEGACY_CSV_FLOAT_FORMAT):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.float_format = float_format
+        self.fmt = table_format(path)
+        self.rows = 0
+        self._writer = None
+        self._blocks = []
+        self._schema = None
+        if self.fmt == "parquet":
+            _require_pyarrow()
+
+    def write(self, df):
+        """Añade un bloque de filas (mismas columnas en todos los bloques)"""
+        if self._schema is None:
+            self._schema = df.iloc[:0]
+        if df.empty:
+            return
+        if self.fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema, compression="zstd")
+            self._writer.write_table(table.cast(self._writer.schema))
+        elif self.fmt in ("fits", "shards"):
+            self._blocks.append(df)
+        else:
+            df.to_csv(self.path, mode="w" if self.rows == 0 else "a", header=self.rows == 0,
+                      index=False, float_format=self.float_format, encoding='utf-8')
+        self.rows += len(df)
+
+    def close(self):
+        """Cierra el fichero (con la cabecera vacía si no se escribió ninguna fila)"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif self.fmt in ("fits", "shards") and self._blocks:
+            write_table(pd.concat(self._blocks, ignore_index=True), self.path)
+            self._blocks = []
+        elif self.rows == 0 and self._schema is not None:
+            write_table(self._schema, self.path, self.float_format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_csv(input_path, output_path, float_format=None):
+    """Exporta una tabla binaria a CSV (pyarrow si está disponible, sin redondeo por defecto)"""
+    df = read_table(input_path)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if float_format is None:
+        try:
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+        except ImportError:
+            df.to_csv(output_path, index=False, encoding='utf-8')
+        else:
+            pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output_path)
+    else:
+        df.to_csv(output_path, index=False, float_format=float_format, encoding='utf-8')
+    return len(df)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exportación de tablas de candidatos JPAS a CSV",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", help="Tabla de entrada (Parquet/FITS/CSV)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="CSV de salida (por defecto, misma ruta con extensión .csv)")
+    parser.add_argument("--float_format", default=None,
+                        help="Formato de los flotantes, p. ej. %%.4f (por defecto sin redondeo)")
+
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(args.input)[0] + ".csv"
+    if os.path.abspath(output) == os.path.abspath(args.input):
+        print("❌ La salida coincide con la entrada")
+        raise SystemExit(1)
+    n = export_csv(args.input, output, args.float_format)
+    print(f"📄 {n} filas exportadas a {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
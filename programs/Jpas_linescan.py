@@ -0,0 +1,269 @@
+"""
+Búsqueda de excesos en todos los filtros estrechos de JPAS en una sola pasada
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, pandas
+
+Para cada filtro estrecho k se estima el continuo local con un ajuste
+lineal ponderado a los filtros vecinos (saltando los adyacentes, que se
+solapan con k), para todos los filtros a la vez mediante productos de
+matrices sobre la matriz de flujos (N objetos × F filtros):
+
+    exceso_k = 2.5 log10(f_k / f_cont,k)      (> 0 para emisión)
+
+En cada tile se ajusta, para todos los filtros simultáneamente, un locus
+lineal exceso_k vs. (m_cont,k − iSDSS) con sigma-clipping; se marcan los
+objetos cuyo residuo supera `sigma_threshold` veces su error total en
+cualquier filtro, y se identifican las líneas que caen en esos filtros
+(Hα, [O III] 5007, Hβ, He II 4686, ... y Hα desplazada al rojo si se pide).
+
+Ejemplo:
+    python Jpas_linescan.py ../Data/jpas_bin_3_17.5to18.5i.fits -f ../JPAS-filters.csv \\
+        -o ../Halpha_emitters/lines_17_185.parquet --redshift 0.1 0.2
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from Jpas_halpha_ew import load_filters, mag_to_flux, BAD_MAG
+from Jpas_io import read_table, write_table
+
+# Líneas de emisión (longitud de onda en reposo, Å)
+EMISSION_LINES = {
+    "OII_3727": 3727.4,
+    "HeII_4686": 4685.7,
+    "Hbeta": 4861.3,
+    "OIII_4959": 4958.9,
+    "OIII_5007": 5006.8,
+    "HeI_5876": 5875.6,
+    "Halpha": 6562.8,
+    "SII_6724": 6724.0,
+    "OII_7325": 7325.0,
+}
+
+# Filtros que no entran en la búsqueda (anchos o de borde)
+EXCLUDED_BANDS = ["uJAVA", "J1007", "iSDSS"]
+REFERENCE_BAND = "iSDSS"
+MAG_FACTOR = 2.5 / np.log(10)
+
+
+def narrow_bands(filters, columns):
+    """Filtros estrechos presentes en la tabla, ordenados por longitud de onda"""
+    present = [n for n in filters.index
+               if n not in EXCLUDED_BANDS and f"mag_{n.lower()}_cor" in columns]
+    return sorted(present, key=lambda n: filters.loc[n, 'wavelength'])
+
+
+def neighbour_matrix(n_bands, n_side=2, gap=1):
+    """Matriz (F, F) con 1 en los vecinos usados para el continuo de cada filtro"""
+    A = np.zeros((n_bands, n_bands))
+    for k in range(n_bands):
+        for off in range(gap + 1, gap + 1 + n_side):
+            for j in (k - off, k + off):
+                if 0 <= j < n_bands:
+                    A[k, j] = 1.0
+    return A
+
+
+def _matrix(df, bands, prefix):
+    return df[[f"{prefix}_{b.lower()}_cor" for b in bands]].to_numpy(dtype=np.float64, copy=True)
+
+
+def local_excess(mags, errs, wavelengths, A, zp=2.41):
+    """Exceso local y su error para todos los objetos y filtros (matrices N × F)
+
+    El continuo de cada filtro es un ajuste lineal ponderado en flujo a sus
+    vecinos (filas de A), evaluado en su longitud de onda.
+    """
+    bad = ~np.isfinite(mags) | ~np.isfinite(errs) | (mags >= BAD_MAG) | (errs <= 0)
+    mags = np.where(bad, np.nan, mags)
+    flux, flux_err = mag_to_flux(mags, errs, wavelengths[None, :], zp)
+
+    W = np.where(bad, 0.0, 1.0 / np.where(bad, 1.0, flux_err)**2)
+    Y = np.where(bad, 0.0, flux)
+    lam = wavelengths[None, :]
+    lam_k = wavelengths[None, :]
+    At = A.T
+
+    # Sumas ponderadas sobre los vecinos de cada filtro, x = λ_j − λ_k
+    S = W @ At
+    SL = (W * lam) @ At
+    SLL = (W * lam**2) @ At
+    Sy = (W * Y) @ At
+    SLy = (W * Y * lam) @ At
+    Sx = SL - lam_k * S
+    Sxx = SLL - 2 * lam_k * SL + lam_k**2 * S
+    Sxy = SLy - lam_k * Sy
+    delta = S * Sxx - Sx**2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n_valid = (W > 0).astype(np.float64) @ At
+        linear = (n_valid >= 2) & (delta > 0)
+        cont = np.where(linear, (Sxx * Sy - Sx * Sxy) / delta, Sy / S)
+        var_cont = np.where(linear, Sxx / delta, 1.0 / S)
+        cont[(n_valid == 0) | (cont <= 0)] = np.nan
+        excess = MAG_FACTOR * np.log(flux / cont)
+        e_excess = MAG_FACTOR * np.sqrt((flux_err / flux)**2 + var_cont / cont**2)
+        m_cont = -2.5 * np.log10(cont * wavelengths[None, :]**2) - zp
+    return excess, e_excess, m_cont
+
+
+def fit_loci(x, y, sigma=4.0, niter=5):
+    """Ajuste lineal con sigma-clipping de cada columna de (x, y) a la vez
+
+    Devuelve pendiente, ordenada, dispersión intrínseca (F,) y la máscara de
+    puntos usados (n, F).
+    """
+    mask = np.isfinite(x) & np.isfinite(y)
+    for _ in range(niter + 1):
+        w = mask.astype(np.float64)
+        xm, ym = np.where(mask, x, 0.0), np.where(mask, y, 0.0)
+        n = w.sum(0)
+        Sx, Sy = xm.sum(0), ym.sum(0)
+        Sxx, Sxy = (xm * xm).sum(0), (xm * ym).sum(0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = n * Sxx - Sx**2
+            slope = np.where(delta > 0, (n * Sxy - Sx * Sy) / delta, 0.0)
+            intercept = np.where(n > 0, (Sy - slope * Sx) / n, np.nan)
+            resid = y - (intercept + slope * x)
+            std = np.sqrt(np.where(mask, resid**2, 0.0).sum(0) / np.maximum(n, 1))
+            new_mask = mask & (np.abs(resid) <= sigma * std)
+        if np.array_equal(new_mask, mask):
+            break
+        mask = new_mask
+    return slope, intercept, std, mask
+
+
+def lines_in_band(wavelength, width, redshifts=(0.0,)):
+    """Líneas (con sufijo de z si z > 0) que caen dentro de un filtro"""
+    found = []
+    for z in redshifts:
+        for name, lam0 in EMISSION_LINES.items():
+            if abs(lam0 * (1 + z) - wavelength) <= width / 2:
+                found.append(name if z == 0 else f"{name}_z{z:g}")
+    return found
+
+
+def scan_tile(tile_data, bands, wavelengths, A, sigma_threshold, zp):
+    """Excesos, residuos respecto al locus y significancias de un tile (n × F)"""
+    mags, errs = _matrix(tile_data, bands, "mag"), _matrix(tile_data, bands, "err")
+    excess, e_excess, m_cont = local_excess(mags, errs, wavelengths, A, zp)
+
+    ref = tile_data[f"mag_{REFERENCE_BAND.lower()}_cor"].to_numpy(dtype=np.float64)
+    e_ref = tile_data[f"err_{REFERENCE_BAND.lower()}_cor"].to_numpy(dtype=np.float64)
+    colour = m_cont - ref[:, None]
+
+    slope, intercept, sigma_int, _ = fit_loci(colour, excess)
+    resid = excess - (intercept + slope * colour)
+    with np.errstate(invalid="ignore"):
+        e_total = np.sqrt(sigma_int**2 + e_excess**2 + (slope * e_ref[:, None])**2)
+        significance = resid / e_total
+    flagged = np.nan_to_num(significance, nan=-np.inf) >= sigma_threshold
+    return excess, significance, flagged
+
+
+def scan(df, filters, sigma_threshold=5.0, n_side=2, gap=1, redshifts=(0.0,), zp=2.41,
+         keep_all_filters=False):
+    """Devuelve los objetos marcados en algún filtro con su identificación de líneas"""
+    bands = narrow_bands(filters, df.columns)
+    wavelengths = filters.loc[bands, 'wavelength'].to_numpy(dtype=np.float64)
+    widths = filters.loc[bands, 'width'].to_numpy(dtype=np.float64)
+    A = neighbour_matrix(len(bands), n_side, gap)
+    band_lines = [lines_in_band(w, wd, redshifts) for w, wd in zip(wavelengths, widths)]
+    all_lines = sorted({line for lines in band_lines for line in lines})
+    line_matrix = np.array([[line in lines for line in all_lines] for lines in band_lines],
+                           dtype=bool).reshape(len(bands), len(all_lines))
+
+    results = []
+    groups = df.groupby('tile_id') if 'tile_id' in df.columns else [(None, df)]
+    for tile_id, tile_data in groups:
+        excess, significance, flagged = scan_tile(tile_data, bands, wavelengths, A,
+                                                  sigma_threshold, zp)
+        any_flag = flagged.any(axis=1)
+        if not any_flag.any():
+            continue
+        sig = np.where(np.isfinite(significance), significance, -np.inf)[any_flag]
+        flag = flagged[any_flag]
+        best = np.argmax(sig, axis=1)
+
+        out = tile_data[any_flag].copy()
+        out["n_bands_flagged"] = flag.sum(axis=1)
+        out["best_band"] = np.array(bands)[best]
+        out["best_sigma"] = sig[np.arange(len(best)), best]
+        out["best_excess"] = excess[any_flag][np.arange(len(best)), best]
+        out["flagged_bands"] = [",".join(np.array(bands)[row]) for row in flag]
+        # Líneas compatibles: alguna banda marcada contiene la línea
+        has_line = (flag.astype(np.int64) @ line_matrix.astype(np.int64)) > 0
+        for j, line in enumerate(all_lines):
+            out[f"line_{line}"] = has_line[:, j]
+        if keep_all_filters:
+            for j, b in enumerate(bands):
+                out[f"excess_{b.lower()}"] = excess[any_flag][:, j]
+                out[f"sig_{b.lower()}"] = significance[any_flag][:, j]
+        results.append(out)
+
+    if not results:
+        return df.iloc[0:0].copy()
+    return pd.concat(results, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Excesos de línea en todos los filtros estrechos JPAS en una pasada",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", help="Bin FITS con todos los filtros (JPAS-data-allFilter.py)")
+    parser.add_argument("-f", "--filters", default="../JPAS-filters.csv",
+                        help="Archivo CSV de definición de filtros (wavelength, width)")
+    parser.add_argument("-o", "--output", default="./resultados/line_emitters.parquet",
+                        help="Salida (.parquet/.fits/.csv)")
+    parser.add_argument("--sigma_threshold", type=float, default=5.0,
+                        help="Umbral de selección en sigmas")
+    parser.add_argument("--n_side", type=int, default=2,
+                        help="Filtros de continuo a cada lado")
+    parser.add_argument("--gap", type=int, default=1,
+                        help="Filtros adyacentes que se saltan (solapamiento)")
+    parser.add_argument("--redshift", type=float, nargs="*", default=[],
+                        help="Redshifts adicionales para identificar líneas desplazadas")
+    parser.add_argument("--zp", type=float, default=2.41,
+                        help="Zero point para conversión de magnitud")
+    parser.add_argument("--all_filters", action="store_true",
+                        help="Guardar exceso y significancia de todos los filtros")
+    parser.add_argument("--quality", action="store_true",
+                        help="Aplicar los filtros de calidad de Selecting_halpha.py")
+
+    args = parser.parse_args()
+
+    print(f"\nCargando datos desde: {args.input}")
+    df = read_table(args.input)
+    if args.quality:
+        from Selecting_halpha import apply_quality_cuts
+        df = apply_quality_cuts(df)
+    filters = load_filters(args.filters)
+
+    redshifts = [0.0] + [z for z in args.redshift if z > 0]
+    bands = narrow_bands(filters, df.columns)
+    if not bands:
+        print("❌ Ningún filtro estrecho (mag_Jxxxx_cor) de la tabla está en el archivo de filtros")
+        print("Use los bins de JPAS-data-allFilter.py y revise la columna name de --filters")
+        raise SystemExit(1)
+    if f"mag_{REFERENCE_BAND.lower()}_cor" not in df.columns:
+        print(f"❌ Falta la banda de referencia {REFERENCE_BAND} (mag_{REFERENCE_BAND.lower()}_cor)")
+        raise SystemExit(1)
+    print(f"Buscando excesos en {len(bands)} filtros ({bands[0]}–{bands[-1]})...")
+    result = scan(df, filters, args.sigma_threshold, args.n_side, args.gap,
+                  redshifts, args.zp, args.all_filters)
+
+    print(f"Objetos con exceso en algún filtro: {len(result)}")
+    for col in [c for c in result.columns if c.startswith("line_")]:
+        print(f"  {col[5:]:<16} {int(result[col].sum())}")
+
+    write_table(result, args.output)
+    print(f"\n✅ {len(result)} objetos guardados en:")
+    print(f"📄 {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""
+Orquestador del flujo JPAS: descarga → bins → selección Hα → duplicados → EW(Hα) / SEDs
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+
+
+Cada etapa se identifica por un hash de su comando, sus parámetros, el
+contenido de sus entradas y las claves de las etapas de las que depende.
+Sólo se re-ejecutan las etapas cuya clave cambió (o cuyas salidas faltan),
+las etapas independientes corren en paralelo y al final se escribe un
+informe de tiempos por etapa (JSON + CSV).
+
+Ejemplos (desde la raíz del repositorio):
+    python programs/Jpas_pipeline.py --dry_run
+    python programs/Jpas_pipeline.py -j 4 --variance_method Mine
+    python programs/Jpas_pipeline.py --config mi_pipeline.json --stages sed
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from Jpas_bins import DEFAULT_BINS, load_plan
+
+STATE_NAME = ".pipeline_state.json"
+
+
+def default_stages(variance_method="Fratta", sigma_threshold=5.0, bins=DEFAULT_BINS, plan=None,
+                   root="."):
+    """Etapas por defecto del repositorio (rutas relativas a la raíz)
+
+    Con `plan` (ruta relativa a la raíz `root`) los bins salen del plan de
+    Jpas_bins.py y la descarga depende del contenido del plan.
+    """
+    py = sys.executable
+    if plan:
+        bins = load_plan(os.path.join(root, plan))
+    bin_files = [f"Data/jpas_bin_{i}_{lo}to{hi}i.fits" for i, (lo, hi) in enumerate(bins, start=1)]
+    stages = [{
+        "name": "download",
+        "cmd": [py, "programs/JPAS-data-v2.py"] + (["--plan", plan] if plan else []),
+        "inputs": ["programs/JPAS-data-v2.py"] + ([plan] if plan else []),
+        "outputs": bin_files,
+        "deps": [],
+        "interactive": True,  # login CEFCA por teclado
+    }]
+    # Intermedios en Parquet: el CSV redondea las coordenadas a %.4f (0.36")
+    selected = []
+    for i, bin_file in enumerate(bin_files, start=1):
+        candidates = f"Halpha_emitters/Halpha_bin_{i}.parquet"
+        selected.append(candidates)
+        stages.append({
+            "name": f"select_{i}",
+            "cmd": [py, "programs/Selecting_halpha.py", bin_file, "-o", candidates,
+                    "--variance_method", variance_method,
+                    "--sigma_threshold", str(sigma_threshold)],
+            "inputs": ["programs/Selecting_halpha.py", bin_file],
+            "outputs": [candidates],
+            "params": {"variance_method": variance_method, "sigma_threshold": sigma_threshold},
+            "deps": ["download"],
+        })
+    # Duplicados sobre la unión de los bins: una fuente puede caer a cada lado de un borde
+    unique = "Halpha_emitters/Halpha_dedup.parquet"
+    stages.append({
+        "name": "dedup",
+        "cmd": [py, "programs/Jpas_dedup.py"] + selected + ["-o", unique],
+        "inputs": ["programs/Jpas_dedup.py"] + selected,
+        "outputs": [unique],
+        "deps": [f"select_{i}" for i in range(1, len(bin_files) + 1)],
+    })
+    stages.append({
+        "name": "ew",
+        # JPAS-data-v2.py no descarga filtros al rojo de J0660: continuo extrapolado
+        "cmd": [py, "programs/Jpas_halpha_ew.py", unique, "-f", "JPAS-filters.csv",
+                "-o", "Halpha_emitters/Halpha_ew.parquet", "--extrapolate"],
+        "inputs": ["programs/Jpas_halpha_ew.py", "JPAS-filters.csv", unique],
+        "outputs": ["Halpha_emitters/Halpha_ew.parquet"],
+        "deps": ["dedup"],
+    })
+    stages.append({
+        "name": "sed",
+        "cmd": [py, "programs/Jpas_SED.py", unique, "-f", "JPAS-filters.csv",
+                "-o", "jpas_seds/candidates"],
+        "inputs": ["programs/Jpas_SED.py", "JPAS-filters.csv", unique],
+        "outputs": ["jpas_seds/candidates"],
+        "deps": ["dedup"],
+    })
+    return stages
+
+
+class Pipeline:
+    """Ejecuta un DAG de etapas con caché por hash de contenido"""
+
+    def __init__(self, stages, root, jobs=1, force=False):
+        self.stages = {s["name"]: s for s in stages}
+        self.root = root
+        self.jobs = jobs
+        self.force = force
+        self.state_path = os.path.join(root, STATE_NAME)
+        self.state = self._load_state()
+        self.keys = {}
+        self.report = []
+        self._lock = threading.Lock()
+        self._interactive = threading.Lock()
+        self._validate()
+
+    # ------------------------------------------------------------------
+    def _validate(self):
+        for name, stage in self.stages.items():
+            for dep in stage.get("deps", []):
+                if dep not in self.stages:
+                    raise SystemExit(f"❌ La etapa '{name}' depende de '{dep}', que no existe")
+        # Detectar ciclos
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise SystemExit(f"❌ Ciclo de dependencias en '{name}'")
+            visiting.add(name)
+            for dep in self.stages[name].get("deps", []):
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {"stages": {}, "files": {}}
+
+    def _save_state(self):
+        with self._lock:
+            tmp = self.state_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.state_path)
+
+    def _path(self, rel):
+        return os.path.join(self.root, rel)
+
+    # ------------------------------------------------------------------
+    def _file_hash(self, rel):
+        """sha256 del contenido, reutilizado mientras no cambien tamaño/mtime"""
+        path = self._path(rel)
+        st = os.stat(path)
+        sig = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            cached = self.state["files"].get(rel)
+        if cached and cached["sig"] == sig:
+            return cached["sha256"]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self.state["files"][rel] = {"sig": sig, "sha256": digest}
+        return digest
+
+    def _input_hash(self, pattern):
+        """Hash de una entrada (archivo, directorio o patrón glob)"""
+        matches = sorted(glob.glob(self._path(pattern)))
+        if not matches:
+            return "missing"
+        h = hashlib.sha256()
+        for match in matches:
+            files = [match]
+            if os.path.isdir(match):
+                files = sorted(os.path.join(d, f) for d, _, fs in os.walk(match) for f in fs)
+            for path in files:
+                rel = os.path.relpath(path, self.root)
+                h.update(rel.encode())
+                h.update(self._file_hash(rel).encode())
+        return h.hexdigest()
+
+    def stage_key(self, name):
+        """Clave de la etapa: comando + parámetros + entradas + claves de dependencias"""
+        stage = self.stages[name]
+        payload = {
+            "cmd": stage["cmd"],
+            "params": stage.get("params", {}),
+            "inputs": {p: self._input_hash(p) for p in stage.get("inputs", [])},
+            "deps": {d: self.keys.get(d) for d in stage.get("deps", [])},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def is_stale(self, name, key):
+        if self.force:
+            return True
+        previous = self.state["stages"].get(name, {})
+        if previous.get("key") != key or previous.get("status") != "ok":
+            return True
+        return any(not glob.glob(self._path(p)) for p in self.stages[name].get("outputs", []))
+
+    # ------------------------------------------------------------------
+    def _run_stage(self, name):
+        stage = self.stages[name]
+        key = self.stage_key(name)
+        self.keys[name] = key
+        record = {"stage": name, "key": key[:12], "wall_time_s": 0.0,
+                  "started": "", "finished": ""}
+
+        if not self.is_stale(name, key):
+            record["status"] = "cached"
+            return record
+
+        for out in stage.get("outputs", []):
+            out_dir = os.path.dirname(self._path(out)) if os.path.splitext(out)[1] else self._path(out)
+            if "*" not in out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+
+        print(f"▶ {name}: {' '.join(stage['cmd'])}")
+        record["started"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        t0 = time.perf_counter()
+        if stage.get("interactive"):
+            # Las etapas interactivas se ejecutan de una en una con la terminal
+            with self._interactive:
+                rc = subprocess.call(stage["cmd"], cwd=self.root)
+        else:
+            rc = subprocess.call(stage["cmd"], cwd=self.root, stdin=subprocess.DEVNULL)
+        record["wall_time_s"] = round(time.perf_counter() - t0, 3)
+        record["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        missing = [p for p in stage.get("outputs", []) if not glob.glob(self._path(p))]
+        if rc != 0 or missing:
+            record["status"] = "failed"
+            print(f"❌ {name} falló (código {rc}, salidas faltantes: {missing})")
+        else:
+            record["status"] = "ok"
+            print(f"✔ {name} ({record['wall_time_s']} s)")
+
+        with self._lock:
+            self.state["stages"][name] = {"key": key, "status": record["status"],
+                                          "wall_time_s": record["wall_time_s"]}
+        self._save_state()
+        return record
+
+    def run(self, targets=None, dry_run=False):
+        """Ejecuta las etapas pedidas (y sus dependencias) respetando el DAG"""
+        selected = set()
+
+        def add(name):
+            if name not in selected:
+                selected.add(name)
+                for dep in self.stages[name].get("deps", []):
+                    add(dep)
+
+        for name in (targets or self.stages):
+            if name not in self.stages:
+                raise SystemExit(f"❌ Etapa desconocida: {name}")
+            add(name)
+
+        if dry_run:
+            # Estimación: una etapa es obsoleta si su clave cambió o alguna dependencia lo es
+            stale = set()
+            for name in self._topological(selected):
+                key = self.stage_key(name)
+                self.keys[name] = key
+                deps_stale = any(d in stale for d in self.stages[name].get("deps", []))
+                if deps_stale or self.is_stale(name, key):
+                    stale.add(name)
+                print(f"{'OBSOLETA' if name in stale else 'al día  '}  {name}")
+            return []
+
+        pending = {name: set(self.stages[name].get("deps", [])) & selected for name in selected}
+        failed = set()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            running = {}
+            while pending or running:
+                for name in [n for n, deps in pending.items() if not deps]:
+                    del pending[name]
+                    running[pool.submit(self._run_stage, name)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    record = future.result()
+                    self.report.append(record)
+                    if record["status"] == "failed":
+                        failed.add(name)
+                    for other, deps in list(pending.items()):
+                        deps.discard(name)
+                # Saltar las etapas que dependen de etapas fallidas
+                changed = True
+                while changed:
+                    changed = False
+                    for other in list(pending):
+                        if set(self.stages[other].get("deps", [])) & failed:
+                            del pending[other]
+                            failed.add(other)
+                            self.report.append({"stage": other, "status": "skipped",
+                                                "key": "", "wall_time_s": 0.0,
+                                                "started": "", "finished": ""})
+                            changed = True
+        self._save_state()
+        return self.report
+
+    def _topological(self, names):
+        order, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for dep in self.stages[name].get("deps", []):
+                if dep in names:
+                    visit(dep)
+            order.append(name)
+
+        for name in sorted(names):
+            visit(name)
+        return order
+
+
+def write_report(report, path):
+    """Informe de tiempos por etapa en JSON y CSV"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    fields = ["stage", "status", "wall_time_s", "started", "finished", "key"]
+    with open(os.path.splitext(path)[0] + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Orquestador de etapas JPAS con caché por hash de contenido",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="Raíz del repositorio (directorio de trabajo de las etapas)")
+    parser.add_argument("--config", default=None,
+                        help="JSON con la lista de etapas (por defecto, el flujo del repositorio)")
+    parser.add_argument("--stages", nargs="+", default=None,
+                        help="Etapas objetivo (se incluyen sus dependencias)")
+    parser.add_argument("--exclude", nargs="+", default=[],
+                        help="Etapas a excluir (p. ej. download si los datos ya existen)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Etapas en paralelo")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-ejecutar todas las etapas seleccionadas")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Sólo mostrar qué etapas están obsoletas")
+    parser.add_argument("--report", default="pipeline_report/timing.json",
+                        help="Informe de tiempos (relativo a la raíz)")
+    parser.add_argument("--variance_method", choices=["Maguio", "Mine", "Fratta"],
+                        default="Fratta", help="Método de varianza para la selección")
+    parser.add_argument("--sigma_threshold", type=float, default=5.0,
+                        help="Umbral de selección en sigmas")
+    parser.add_argument("--plan", default=None,
+                        help="Plan de bins de Jpas_bins.py (relativo a la raíz), p. ej. Data/shard_plan.json")
+
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config) as f:
+            stages = json.load(f)
+    else:
+        if args.plan:
+            args.plan = os.path.relpath(os.path.abspath(args.plan), args.root)
+        stages = default_stages(args.variance_method, args.sigma_threshold, plan=args.plan,
+                                root=args.root)
+
+    excluded = set(args.exclude)
+    stages = [dict(s, deps=[d for d in s.get("deps", []) if d not in excluded])
+              for s in stages if s["name"] not in excluded]
+
+    pipeline = Pipeline(stages, args.root, jobs=args.jobs, force=args.force)
+    report = pipeline.run(args.stages, dry_run=args.dry_run)
+    if args.dry_run:
+        return
+
+    report_path = os.path.join(args.root, args.report)
+    write_report(report, report_path)
+
+    counts = {}
+    for record in report:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+    print(f"\n✅ Pipeline terminado: {counts}")
+    print(f"📄 Informe de tiempos: {report_path}")
+    if counts.get("failed") or counts.get("skipped"):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Instrumentación por etapa para los scripts JPAS (tiempo, CPU, memoria, filas)
+Autor: Luis A. Gutiérrez Soto
+
+Uso:
+    prof = StageProfiler(enabled=True)
+    with prof.stage("read_fits") as rec:
+        data = ...
+        rec["rows"] = len(data)
+    with prof.stage("select_tile", tile=tile_id, rows=len(tile_data)):
+        ...
+    prof.write("salida_profile.json")   # escribe también salida_profile.csv
+"""
+
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes en macOS, KiB en Linux
+
+
+def _peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+def _current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return _peak_rss_bytes()
+
+
+def _reset_peak_rss():
+    """Reinicia el pico de RSS (Linux >= 4.0); devuelve False si no es posible"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class StageProfiler:
+    """Registra tiempo de reloj, CPU, pico de RSS y filas por etapa y por tile"""
+
+    FIELDS = ["stage", "tile", "rows", "wall_s", "cpu_s", "peak_rss_mb", "rss_mb", "rows_per_s"]
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.t_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, tile=None, rows=None):
+        """Context manager que mide una etapa; el dict cedido admite `rows`"""
+        record = {"stage": name, "tile": tile, "rows": rows}
+        if not self.enabled:
+            yield record
+            return
+        # Sólo las etapas externas reinician el pico (las anidadas lo heredan)
+        per_stage_peak = self._depth == 0 and _reset_peak_rss()
+        self._depth += 1
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            self._depth -= 1
+            wall = time.perf_counter() - t0
+            record["wall_s"] = round(wall, 6)
+            record["cpu_s"] = round(time.process_time() - c0, 6)
+            record["peak_rss_mb"] = round(_peak_rss_bytes() / 2**20, 2)
+            record["rss_mb"] = round(_current_rss_bytes() / 2**20, 2)
+            record["peak_is_per_stage"] = per_stage_peak
+            rows = record.get("rows")
+            record["rows_per_s"] = round(rows / wall, 1) if rows and wall > 0 else None
+            self.records.append(record)
+
+    def summary(self):
+        """Totales por etapa (sumando los tiles)"""
+        totals = {}
+        for rec in self.records:
+            t = totals.setdefault(rec["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                                 "rows": 0, "peak_rss_mb": 0.0})
+            t["calls"] += 1
+            t["wall_s"] += rec["wall_s"]
+            t["cpu_s"] += rec["cpu_s"]
+            t["rows"] += rec["rows"] or 0
+            t["peak_rss_mb"] = max(t["peak_rss_mb"], rec["peak_rss_mb"])
+        return totals
+
+    def hot_tiles(self, n=5):
+        """Los `n` tiles más lentos"""
+        tiles = [r for r in self.records if r["tile"] is not None]
+        return sorted(tiles, key=lambda r: r["wall_s"], reverse=True)[:n]
+
+    def write(self, path):
+        """Escribe el perfil en JSON (con resumen) y CSV (un registro por fila)"""
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        report = {
+            "argv": sys.argv,
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(time.time() - (time.perf_counter() - self.t_start))),
+            "total_wall_s": round(time.perf_counter() - self.t_start, 6),
+            "total_cpu_s": round(time.process_time() - self.cpu_start, 6),
+            "peak_rss_mb": round(max([r["peak_rss_mb"] for r in self.records], default=0.0), 2),
+            "summary": self.summary(),
+            "records": self.records,
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        with open(os.path.splitext(path)[0] + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(self.records)
+
+    def print_summary(self, n_tiles=5):
+        if not self.enabled:
+            return
+        print("\n⏱  Perfil por etapa:")
+        for name, t in self.summary().items():
+            print(f"  {name:<16} {t['wall_s']:9.3f} s  CPU {t['cpu_s']:9.3f} s  "
+                  f"filas {t['rows']:>10}  pico RSS {t['peak_rss_mb']:8.1f} MB")
+        hot = self.hot_tiles(n_tiles)
+        if hot:
+            print("  Tiles más lentos: " +
+                  ", ".join(f"{r['tile']} ({r['wall_s']:.3f} s, {r['rows']} filas)" for r in hot))
+
+
+@contextlib.contextmanager
+def run_profiler(kind, output_prefix):
+    """Envuelve la ejecución con cProfile o un perfilador por muestreo (pyinstrument)"""
+    if kind in (None, "none"):
+        yield
+        return
+
+    if kind == "cprofile":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_prefix + ".prof")
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(40)
+            with open(output_prefix + "_cprofile.txt", "w") as f:
+                f.write(stream.getvalue())
+            print(f"📄 cProfile: {output_prefix}.prof")
+        return
+
+    if kind == "sampling":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("❌ El perfilador por muestreo requiere pyinstrument (pip install pyinstrument)")
+            raise SystemExit(1)
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(output_prefix + "_sampling.html", "w") as f:
+                f.write(profiler.output_html())
+            with open(output_prefix + "_sampling.txt", "w") as f:
+                f.write(profiler.output_text())
+            print(f"📄 Perfil por muestreo: {output_prefix}_sampling.html")
+        return
+
+    raise ValueError(f"Perfilador desconocido: {kind}")
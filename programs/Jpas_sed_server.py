@@ -0,0 +1,326 @@
+"""
+Servicio HTTP local de SEDs JPAS bajo demanda, con caché LRU de gráficos
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, numpy, pandas, scipy, matplotlib
+
+En lugar de renderizar en lote un PDF por candidato (Jpas_SED.py), el
+servidor carga las tablas de candidatos una vez, las indexa por `number`
+(y `tile_id`) y por posición (k-d tree sobre vectores unitarios), y dibuja
+la SED de un objeto sólo cuando se pide. Los PNG/SVG generados se guardan
+en una caché LRU acotada en memoria y en disco, así que volver a un objeto
+ya visto es inmediato incluso tras reiniciar el servidor.
+
+Rutas:
+    /                                 lista navegable de candidatos
+    /sed/<number>.png                 SED por identificador (?tile=<tile_id> si se repite)
+    /sed.svg?ra=<deg>&dec=<deg>       SED del candidato más cercano (?radius=<arcsec>)
+    /object/<number>                  fila del catálogo en JSON
+    /stats                            estado de la caché
+
+Ejemplo:
+    python Jpas_sed_server.py ../Halpha_emitters/Halpha_*.parquet -f ../JPAS-filters.csv --port 8765
+    # http://127.0.0.1:8765/sed/1234.png
+"""
+
+import argparse
+import glob
+import hashlib
+import html
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from Jpas_SED import load_jpas_filters, render_sed
+from Jpas_index import arcsec_to_chord, chord_to_arcsec, radec_to_xyz
+from Jpas_io import read_table
+
+CONTENT_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+class PlotCache:
+    """Caché LRU de gráficos (bytes) acotada en memoria y en disco
+
+    La memoria guarda los más recientes hasta `max_memory_bytes`; el disco
+    (un fichero por gráfico en `cache_dir`) hasta `max_disk_bytes`, y el
+    orden LRU en disco se conserva en el mtime de cada fichero.
+    """
+
+    def __init__(self, cache_dir=None, max_memory_bytes=64 << 20, max_disk_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.hits = {"memory": 0, "disk": 0, "miss": 0}
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            entries = [e for e in os.scandir(cache_dir) if e.is_file()]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                self.disk[entry.name] = entry.stat().st_size
+                self.disk_bytes += entry.stat().st_size
+            self._evict_disk()
+
+    def get(self, key):
+        """Bytes del gráfico o None (promueve la entrada a la más reciente)"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return self.memory[key]
+            if key not in self.disk:
+                self.hits["miss"] += 1
+                return None
+            path = os.path.join(self.cache_dir, key)
+            self.disk.move_to_end(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.disk_bytes -= self.disk.pop(key, 0)
+                self.hits["miss"] += 1
+            return None
+        with self.lock:
+            self.hits["disk"] += 1
+            self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        with self.lock:
+            self._put_memory(key, data)
+            if not self.cache_dir:
+                return
+            path = os.path.join(self.cache_dir, key)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.disk_bytes += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            self._evict_disk()
+
+    def _put_memory(self, key, data):
+        self.memory_bytes += len(data) - len(self.memory.pop(key, b""))
+        self.memory[key] = data
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, old = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old)
+
+    def _evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            name, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"memory_items": len(self.memory), "memory_mb": self.memory_bytes / 2**20,
+                    "disk_items": len(self.disk), "disk_mb": self.disk_bytes / 2**20,
+                    "hits": dict(self.hits)}
+
+
+def files_signature(paths):
+    """Huella corta (ruta, tamaño, fecha) de unos ficheros"""
+    signature = "|".join(f"{p}:{os.path.getsize(p)}:{os.path.getmtime(p)}" for p in paths)
+    return hashlib.sha256(signature.encode()).hexdigest()[:12]
+
+
+class CandidateStore:
+    """Tablas de candidatos en memoria con índices por `number` y por posición"""
+
+    def __init__(self, paths):
+        self.paths = sorted(paths)
+        self.df = pd.concat([read_table(p) for p in self.paths], ignore_index=True)
+        self.by_number = {}
+        numbers = self.df["number"].to_numpy()
+        tiles = self.df["tile_id"].to_numpy() if "tile_id" in self.df else np.zeros(len(self.df))
+        for pos in range(len(self.df)):
+            self.by_number.setdefault(int(numbers[pos]), []).append((int(tiles[pos]), pos))
+        self.tree = cKDTree(radec_to_xyz(self.df["alpha_j2000"], self.df["delta_j2000"]))
+        # Huella de las tablas: invalida la caché en disco si cambian
+        self.signature = files_signature(self.paths)
+
+    def find_number(self, number, tile_id=None):
+        """Posición de un objeto por identificador (y tile si el número se repite)"""
+        matches = self.by_number.get(number, [])
+        if tile_id is not None:
+            matches = [m for m in matches if m[0] == tile_id]
+        return matches[0][1] if matches else None
+
+    def find_position(self, ra, dec, radius_arcsec=2.0):
+        """Posición del candidato más cercano a (ra, dec) dentro del radio, y su separación"""
+        dist, pos = self.tree.query(radec_to_xyz([ra], [dec])[0],
+                                    distance_upper_bound=arcsec_to_chord(radius_arcsec))
+        if not np.isfinite(dist):
+            return None, None
+        return int(pos), float(chord_to_arcsec(dist))
+
+
+class SEDServer:
+    """Renderiza SEDs bajo demanda usando la caché antes que matplotlib"""
+
+    def __init__(self, store, filters, cache, zp=2.41, dpi=100, quiet=False, filters_signature=""):
+        self.store = store
+        self.filters = filters
+        self.filters_signature = filters_signature
+        self.cache = cache
+        self.zp = zp
+        self.dpi = dpi
+        self.quiet = quiet
+        self.render_lock = threading.Lock()
+
+    def sed_bytes(self, pos, fmt):
+        row = self.store.df.iloc[pos]
+        tile = int(row["tile_id"]) if "tile_id" in row else 0
+        key = (f"sed_{int(row['number'])}_{tile}_{self.store.signature}_"
+               f"{self.filters_signature}_{self.zp:g}_{self.dpi}.{fmt}")
+        data = self.cache.get(key)
+        if data is None:
+            # Agg es reentrante por figura, pero el texto matemático comparte cachés
+            with self.render_lock:
+                data = render_sed(row, self.filters, self.zp, fmt=fmt, dpi=self.dpi)
+            self.cache.put(key, data)
+        return data
+
+
+def make_handler(server):
+    """Clase manejadora HTTP ligada a una instancia de SEDServer"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                if url.path in ("/", "/index.html"):
+                    return self._send(200, "text/html; charset=utf-8", self._index(query))
+                if url.path == "/stats":
+                    stats = dict(server.cache.stats(), objects=len(server.store.df))
+                    return self._json(200, stats)
+                if url.path.startswith("/object/"):
+                    pos = self._lookup(url.path[len("/object/"):], query)
+                    if pos is None:
+                        return self._json(404, {"error": "objeto no encontrado"})
+                    return self._send(200, "application/json",
+                                      server.store.df.iloc[pos].to_json().encode())
+                if url.path.startswith("/sed"):
+                    name, _, fmt = url.path[len("/sed"):].lstrip("/").partition(".")
+                    fmt = fmt or query.get("fmt", "png")
+                    if fmt not in CONTENT_TYPES:
+                        return self._json(400, {"error": f"formato no soportado: {fmt}"})
+                    pos = self._lookup(name, query)
+                    if pos is None:
+                        return self._json(404, {"error": "objeto no encontrado"})
+                    return self._send(200, CONTENT_TYPES[fmt], server.sed_bytes(pos, fmt))
+                return self._json(404, {"error": "ruta desconocida"})
+            except ValueError as e:
+                return self._json(400, {"error": str(e)})
+
+        def _lookup(self, name, query):
+            if name:
+                tile = int(query["tile"]) if "tile" in query else None
+                return server.store.find_number(int(name), tile)
+            if "ra" in query and "dec" in query:
+                pos, _ = server.store.find_position(float(query["ra"]), float(query["dec"]),
+                                                    float(query.get("radius", 2.0)))
+                return pos
+            raise ValueError("se requiere /sed/<number> o ?ra=&dec=")
+
+        def _index(self, query):
+            df = server.store.df
+            page, per_page = int(query.get("page", 0)), int(query.get("per_page", 100))
+            block = df.iloc[page * per_page:(page + 1) * per_page]
+            rows = []
+            for _, row in block.iterrows():
+                tile = int(row["tile_id"]) if "tile_id" in row else 0
+                link = f"/sed/{int(row['number'])}.png?tile={tile}"
+                rows.append(f"<tr><td><a href='{link}'>{int(row['number'])}</a></td>"
+                            f"<td>{tile}</td><td>{row['alpha_j2000']:.5f}</td>"
+                            f"<td>{row['delta_j2000']:.5f}</td></tr>")
+            nav = (f"<a href='/?page={max(page - 1, 0)}&per_page={per_page}'>&laquo;</a> "
+                   f"{page * per_page}–{page * per_page + len(block)} de {len(df)} "
+                   f"<a href='/?page={page + 1}&per_page={per_page}'>&raquo;</a>")
+            title = html.escape(", ".join(os.path.basename(p) for p in server.store.paths))
+            return (f"<html><head><meta charset='utf-8'><title>SEDs JPAS</title></head><body>"
+                    f"<h3>{title}</h3><p>{nav}</p><table><tr><th>number</th><th>tile</th>"
+                    f"<th>RA</th><th>Dec</th></tr>{''.join(rows)}</table></body></html>").encode()
+
+        def _json(self, code, obj):
+            self._send(code, "application/json", json.dumps(obj).encode())
+
+        def _send(self, code, content_type, body):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            if not server.quiet:
+                super().log_message(fmt, *args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Servicio HTTP de SEDs JPAS bajo demanda con caché LRU",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("candidates", nargs="+",
+                        help="Tablas de candidatos (CSV/Parquet/FITS, admite comodines)")
+    parser.add_argument("-f", "--filters", default="../JPAS-filters.csv",
+                        help="Archivo CSV de definición de filtros")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cache_dir", default="../jpas_seds/cache",
+                        help="Caché en disco de PNG/SVG ('' para desactivarla)")
+    parser.add_argument("--memory_mb", type=float, default=64,
+                        help="Tamaño máximo de la caché en memoria")
+    parser.add_argument("--disk_mb", type=float, default=1024,
+                        help="Tamaño máximo de la caché en disco")
+    parser.add_argument("--zp", type=float, default=2.41,
+                        help="Zero point para conversión de magnitud")
+    parser.add_argument("--dpi", type=int, default=100, help="Resolución de los PNG")
+    parser.add_argument("--quiet", action="store_true", help="No registrar cada petición")
+
+    args = parser.parse_args()
+    paths = sorted({p for pattern in args.candidates for p in (glob.glob(pattern) or [pattern])})
+
+    t0 = time.perf_counter()
+    store = CandidateStore(paths)
+    filters = load_jpas_filters(args.filters)
+    cache = PlotCache(args.cache_dir or None, int(args.memory_mb * 2**20),
+                      int(args.disk_mb * 2**20))
+    sed_server = SEDServer(store, filters, cache, args.zp, args.dpi, args.quiet,
+                           files_signature([os.path.abspath(args.filters)]))
+    print(f"📚 {len(store.df)} candidatos de {len(paths)} tablas indexados "
+          f"en {time.perf_counter() - t0:.2f} s")
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(sed_server))
+    print(f"🌐 http://{args.host}:{args.port}/  (Ctrl-C para terminar)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nServidor detenido")
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Sincronización incremental (delta) de un data release de JPAS por tiles
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, pyvo, astropy, numpy, pandas
+
+Compara la lista de tiles del release remoto (número de filas y sumas de
+control por tile, obtenidas con una única consulta agregada) con el
+almacén local, descarga sólo los tiles nuevos o modificados y vuelve a
+ejecutar la selección Hα únicamente sobre esos tiles.
+
+El locus de cada tile se ajusta bin a bin de magnitud iSDSS (los mismos
+bins que la descarga, o los de un plan de Jpas_bins.py con --plan), igual
+que al ejecutar Selecting_halpha.py sobre cada jpas_bin_*: así un tile
+sincronizado da los mismos candidatos que una re-ejecución completa. Los
+objetos fuera de los bins no se seleccionan, como en la descarga.
+
+El manifiesto guarda también, por tile, el estado de su selección (hash
+de los parámetros, bins y directorio de candidatos, y el fichero
+escrito). Se vuelven a seleccionar los tiles descargados de nuevo y los
+que no tienen selección al día (fallida, interrumpida, o hecha con otros
+parámetros o sin --candidates_dir); la unión sólo usa selecciones al día.
+
+Ejemplo:
+    python Jpas_sync.py --release jpas-idr202406 --store ../Data/tiles \\
+        --candidates_dir ../Halpha_emitters/tiles --merged_output ../Halpha_emitters/Halpha_all.parquet
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import Jpas_tap
+from Jpas_bins import DEFAULT_BINS, load_plan
+from Jpas_io import read_table, write_table
+from Selecting_halpha import load_data, apply_quality_cuts, compute_colors, select_candidates
+
+# Ignorar warnings
+warnings.simplefilter("ignore")
+
+MANIFEST_NAME = "manifest.json"
+CANDIDATE_FORMATS = ("parquet", "fits", "csv")
+
+# Resumen por tile: filas + sumas de control (detectan altas/bajas y recalibraciones)
+TILE_SUMMARY_QUERY = f"""
+SELECT
+    tile_id,
+    COUNT(*) AS n_rows,
+    SUM(NUMBER) AS sum_number,
+    SUM(mag_aper_cor_6_0[jpas::J0660]) AS sum_j0660
+FROM
+    jpas.MagABDualObj
+WHERE {Jpas_tap.QUALITY_WHERE}
+GROUP BY tile_id
+"""
+
+
+def tile_filename(tile_id):
+    return f"tile_{int(tile_id)}.fits"
+
+
+def candidates_filename(tile_id, fmt="parquet"):
+    return f"cand_{int(tile_id)}.{fmt}"
+
+
+def load_manifest(store):
+    path = os.path.join(store, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"release": None, "tiles": {}}
+
+
+def save_manifest(store, manifest):
+    path = os.path.join(store, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def remote_tile_summary(service):
+    """Resumen {tile_id: firma} del release remoto"""
+    table = service.run_async(TILE_SUMMARY_QUERY).to_table()
+    summary = {}
+    for row in table:
+        summary[str(int(row["tile_id"]))] = {
+            "n_rows": int(row["n_rows"]),
+            "sum_number": int(row["sum_number"]),
+            "sum_j0660": float(row["sum_j0660"]),
+        }
+    return summary
+
+
+def _same_signature(local, remote):
+    return (
+        local.get("n_rows") == remote["n_rows"]
+        and local.get("sum_number") == remote["sum_number"]
+        and np.isclose(local.get("sum_j0660", np.nan), remote["sum_j0660"], rtol=1e-9, atol=1e-6)
+    )
+
+
+def diff_tiles(manifest, remote, store):
+    """Clasifica los tiles en nuevos, modificados y eliminados"""
+    local = manifest["tiles"]
+    new, changed = [], []
+    for tile_id, sig in remote.items():
+        if tile_id not in local:
+            new.append(tile_id)
+        elif not _same_signature(local[tile_id], sig) or \
+                not os.path.exists(os.path.join(store, tile_filename(tile_id))):
+            changed.append(tile_id)
+    removed = [tile_id for tile_id in local if tile_id not in remote]
+    return sorted(new, key=int), sorted(changed, key=int), sorted(removed, key=int)
+
+
+def download_tiles(service, tile_ids, remote, manifest, store, filters, batch_tiles):
+    """Descarga los tiles indicados (por lotes) y actualiza el manifiesto"""
+    for start in range(0, len(tile_ids), batch_tiles):
+        batch = tile_ids[start:start + batch_tiles]
+        query = Jpas_tap.photometry_query(
+            filters, extra_where=f"AND tile_id IN ({', '.join(batch)})"
+        )
+        try:
+            table = service.run_async(query).to_table()
+        except Exception as e:
+            print(f"❌ Error descargando tiles {batch}: {e}")
+            raise SystemExit(1)
+        Jpas_tap.clean_meta(table)
+
+        for tile_id in batch:
+            tile_data = table[table["tile_id"] == int(tile_id)]
+            filename = os.path.join(store, tile_filename(tile_id))
+            tile_data.write(filename, overwrite=True, format='fits')
+            manifest["tiles"][tile_id] = dict(remote[tile_id], file=tile_filename(tile_id))
+            print(f"Tile {tile_id}: {len(tile_data)} objetos guardados en {filename}")
+        # Guardar tras cada lote para poder reanudar si se interrumpe
+        save_manifest(store, manifest)
+
+
+def selection_key(candidates_dir, variance_method, sigma_threshold, bins, fmt):
+    """Hash de todo lo que determina los candidatos de un tile (salvo sus datos)"""
+    payload = {"candidates_dir": os.path.abspath(candidates_dir),
+               "variance_method": variance_method, "sigma_threshold": sigma_threshold,
+               "bins": [list(b) for b in bins], "format": fmt}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def selection_current(entry, key, candidates_dir):
+    """¿La selección guardada de un tile corresponde a `key` y su fichero existe?"""
+    selection = entry.get("selection")
+    if not selection or selection.get("key") != key:
+        return False
+    return selection["file"] is None or \
+        os.path.exists(os.path.join(candidates_dir, selection["file"]))
+
+
+def pending_selection(manifest, key, candidates_dir):
+    """Tiles del almacén cuya selección falta o está obsoleta"""
+    return sorted((tile_id for tile_id, entry in manifest["tiles"].items()
+                   if not selection_current(entry, key, candidates_dir)), key=int)
+
+
+def remove_candidates(candidates_dir, tile_id):
+    """Borra los candidatos de un tile en cualquiera de los formatos"""
+    for fmt in CANDIDATE_FORMATS:
+        path = os.path.join(candidates_dir, candidates_filename(tile_id, fmt))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def select_tile_bins(df, bins, variance_method, sigma_threshold):
+    """Candidatos de un tile con el locus ajustado en cada bin de magnitud iSDSS"""
+    parts = []
+    for min_mag, max_mag in bins:
+        in_bin = df[(df["mag_isdss_cor"] >= min_mag) & (df["mag_isdss_cor"] < max_mag)]
+        if len(in_bin):
+            parts.append(select_candidates(compute_colors(in_bin.copy()),
+                                           variance_method, sigma_threshold))
+    return pd.concat(parts, ignore_index=True) if parts else None
+
+
+def select_tiles(tile_ids, manifest, store, candidates_dir, variance_method, sigma_threshold,
+                 bins=DEFAULT_BINS, fmt="parquet"):
+    """Vuelve a ejecutar la selección Hα sobre los tiles indicados
+
+    El estado de selección de cada tile se borra antes de tocar sus
+    candidatos y sólo se vuelve a guardar cuando la nueva selección está
+    escrita: un fallo o una interrupción dejan el tile pendiente para la
+    siguiente ejecución. Devuelve los tiles cuya selección falló.
+    """
+    os.makedirs(candidates_dir, exist_ok=True)
+    key = selection_key(candidates_dir, variance_method, sigma_threshold, bins, fmt)
+    failed = []
+    for tile_id in tile_ids:
+        entry = manifest["tiles"][tile_id]
+        entry.pop("selection", None)
+        save_manifest(store, manifest)
+        remove_candidates(candidates_dir, tile_id)
+        try:
+            df = apply_quality_cuts(load_data(os.path.join(store, tile_filename(tile_id))))
+            candidates = select_tile_bins(df, bins, variance_method, sigma_threshold)
+            filename = None
+            if candidates is not None:
+                filename = candidates_filename(tile_id, fmt)
+                write_table(candidates, os.path.join(candidates_dir, filename))
+        except Exception as e:
+            print(f"❌ Error en la selección del tile {tile_id}: {type(e).__name__}: {e}")
+            remove_candidates(candidates_dir, tile_id)
+            failed.append(tile_id)
+            continue
+        entry["selection"] = {"key": key, "file": filename}
+        save_manifest(store, manifest)
+        print(f"Tile {tile_id}: {0 if candidates is None else len(candidates)} candidatos")
+    return failed
+
+
+def merge_candidates(manifest, candidates_dir, output):
+    """Une los candidatos de las selecciones registradas en el manifiesto"""
+    files = [os.path.join(candidates_dir, entry["selection"]["file"])
+             for _, entry in sorted(manifest["tiles"].items(), key=lambda kv: int(kv[0]))
+             if (entry.get("selection") or {}).get("file")]
+    if not files:
+        print("No hay candidatos que unir")
+        return
+    merged = pd.concat([read_table(f) for f in files], ignore_index=True)
+    write_table(merged, output)
+    print(f"📄 {len(merged)} candidatos unidos en {os.path.abspath(output)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sincronización incremental de un release JPAS por tiles",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--release", default=Jpas_tap.DEFAULT_RELEASE,
+                        help="Data release (parte final de la URL TAP)")
+    parser.add_argument("--store", default="Data/tiles",
+                        help="Directorio del almacén local por tiles")
+    parser.add_argument("--filters", choices=["all", "halpha"], default="all",
+                        help="Filtros a descargar (todos o sólo los de la selección Hα)")
+    parser.add_argument("--batch_tiles", type=int, default=20,
+                        help="Tiles por consulta de descarga")
+    parser.add_argument("--candidates_dir", default=None,
+                        help="Directorio de candidatos por tile (activa la re-selección)")
+    parser.add_argument("--candidates_format", choices=CANDIDATE_FORMATS, default="parquet",
+                        help="Formato de los candidatos por tile")
+    parser.add_argument("--merged_output", default=None,
+                        help="Archivo con todos los candidatos unidos (.parquet/.fits o .csv)")
+    parser.add_argument("--plan", default=None,
+                        help="Plan de bins de Jpas_bins.py para el ajuste del locus "
+                             "(por defecto, los bins fijos de la descarga)")
+    parser.add_argument("--variance_method", choices=["Maguio", "Mine", "Fratta"],
+                        default="Fratta", help="Método de cálculo de varianza")
+    parser.add_argument("--sigma_threshold", type=float, default=5.0,
+                        help="Umbral de selección en sigmas")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Sólo mostrar qué tiles cambiarían")
+
+    args = parser.parse_args()
+    os.makedirs(args.store, exist_ok=True)
+    filters = Jpas_tap.ALL_FILTERS if args.filters == "all" else Jpas_tap.HALPHA_FILTERS
+
+    service = Jpas_tap.login(args.release)
+    manifest = load_manifest(args.store)
+    if manifest["release"] not in (None, args.release):
+        print(f"Release local {manifest['release']} → remoto {args.release}")
+
+    print("Consultando resumen de tiles remoto...")
+    remote = remote_tile_summary(service)
+    new, changed, removed = diff_tiles(manifest, remote, args.store)
+    print(f"Tiles remotos: {len(remote)} | nuevos: {len(new)} | "
+          f"modificados: {len(changed)} | eliminados: {len(removed)}")
+
+    bins = load_plan(args.plan) if args.plan else DEFAULT_BINS
+    key = None
+    if args.candidates_dir:
+        key = selection_key(args.candidates_dir, args.variance_method, args.sigma_threshold,
+                            bins, args.candidates_format)
+
+    if args.dry_run:
+        stale = []
+        if key:
+            stale = [t for t in pending_selection(manifest, key, args.candidates_dir)
+                     if t not in new + changed + removed]
+        for label, tiles in (("Nuevos", new), ("Modificados", changed), ("Eliminados", removed),
+                             ("Selección pendiente", stale)):
+            if tiles:
+                print(f"{label}: {', '.join(tiles)}")
+        return
+
+    affected = new + changed
+    download_tiles(service, affected, remote, manifest, args.store, filters, args.batch_tiles)
+
+    for tile_id in removed:
+        stale = [os.path.join(args.store, tile_filename(tile_id))]
+        for path in stale:
+            if os.path.exists(path):
+                os.remove(path)
+        if args.candidates_dir:
+            remove_candidates(args.candidates_dir, tile_id)
+        del manifest["tiles"][tile_id]
+
+    manifest["release"] = args.release
+    save_manifest(args.store, manifest)
+
+    if args.candidates_dir:
+        # Los tiles descargados no tienen estado de selección: van incluidos
+        pending = pending_selection(manifest, key, args.candidates_dir)
+        print(f"\nRe-seleccionando {len(pending)} tiles...")
+        failed = select_tiles(pending, manifest, args.store, args.candidates_dir,
+                              args.variance_method, args.sigma_threshold, bins,
+                              args.candidates_format)
+        if failed:
+            print(f"❌ Selección fallida en {len(failed)} tiles ({', '.join(failed)}): "
+                  "quedan pendientes para la próxima ejecución")
+            if args.merged_output:
+                print(f"No se escribe {args.merged_output}: faltarían esos tiles")
+            raise SystemExit(1)
+        if args.merged_output:
+            merge_candidates(manifest, args.candidates_dir, args.merged_output)
+
+    print(f"\n✅ Sincronización completada ({len(affected)} tiles actualizados)")
+
+
+if __name__ == "__main__":
+    main()
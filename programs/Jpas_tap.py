@@ -0,0 +1,134 @@
+"""
+Utilidades comunes para el acceso TAP a JPAS (login CEFCA y consultas)
+Autor: Luis A. Gutiérrez Soto
+
+pyvo y requests se importan sólo al conectar: las constantes y consultas
+se pueden usar (Jpas_bins, Jpas_pipeline) sin ellos instalados.
+"""
+import getpass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+TAP_BASE_URL = "https://archive.cefca.es/catalogues/vo/tap/"
+DEFAULT_RELEASE = "jpas-idr202406"
+ARCHIVE_LOGIN_URL = "https://archive.cefca.es/catalogues/login"
+
+# List completa de filtros JPAS
+ALL_FILTERS = [
+    "uJAVA", "J0378", "J0390", "J0400", "J0410", "J0420", "J0430", "J0440",
+    "J0450", "J0460", "J0470", "J0480", "J0490", "J0500", "J0510", "J0520",
+    "J0530", "J0540", "J0550", "J0560", "J0570", "J0580", "J0590", "J0600",
+    "J0610", "J0620", "J0630", "J0640", "J0650", "J0660", "J0670", "J0680",
+    "J0690", "J0700", "J0710", "J0720", "J0730", "J0740", "J0750", "J0760",
+    "J0770", "J0780", "J0790", "J0800", "J0810", "J0820", "J0830", "J0840",
+    "J0850", "J0860", "J0870", "J0880", "J0890", "J0900", "J0910", "J1007",
+    "iSDSS"
+]
+
+# Filtros necesarios para la selección Hα (pseudo-r + J0660 + iSDSS)
+HALPHA_FILTERS = ["J0600", "J0610", "J0620", "J0630", "J0640", "J0650", "J0660", "iSDSS"]
+
+# Filtros de calidad aplicados en el servidor
+QUALITY_WHERE = """
+    mag_err_aper_cor_6_0[jpas::J0600] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::J0610] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::J0620] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::J0630] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::J0640] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::J0650] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::J0660] < 0.4
+    AND mag_err_aper_cor_6_0[jpas::iSDSS] < 0.4
+    AND mask_flags[jpas::J0660] = 0
+    AND mask_flags[jpas::iSDSS] = 0
+    AND flags[jpas::J0660] <= 3
+    AND flags[jpas::iSDSS] <= 3"""
+
+
+def tap_url(release=DEFAULT_RELEASE):
+    """URL del servicio TAP para un data release"""
+    return TAP_BASE_URL + release
+
+
+def login(release=DEFAULT_RELEASE, user=None, pwd=None):
+    """Login (credenciales CEFCA) y conexión al servicio TAP"""
+    import requests
+    import pyvo
+    import pyvo.dal
+    from pyvo.auth import authsession, securitymethods
+
+    if user is None:
+        user = input("Username: ")
+    if pwd is None:
+        pwd = getpass.getpass("Password: ")
+    login_args = {"login": user, "password": pwd, "submit": "Sign+In"}
+    login_header = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+
+    # Configurar sesión autenticada
+    pyvo.dal.tap.s = requests.Session()
+    response = pyvo.dal.tap.s.post(ARCHIVE_LOGIN_URL, data=login_args, headers=login_header)
+    response.raise_for_status()
+
+    auth = authsession.AuthSession()
+    auth.credentials.set(securitymethods.ANONYMOUS, pyvo.dal.tap.s)
+
+    # Conectar al servicio TAP
+    return pyvo.dal.TAPService(tap_url(release), session=auth)
+
+
+def photometry_query(filters=ALL_FILTERS, extra_where=""):
+    """Consulta de fotometría corregida (apertura 6") para los filtros dados"""
+    mag_lines = [f"mag_aper_cor_6_0[jpas::{filt}] AS mag_{filt}_cor" for filt in filters]
+    err_lines = [f"mag_err_aper_cor_6_0[jpas::{filt}] AS err_{filt}_cor" for filt in filters]
+    mag_part = ",\n    ".join(mag_lines)
+    err_part = ",\n    ".join(err_lines)
+    return f"""
+SELECT
+    NUMBER,
+    alpha_j2000,
+    delta_j2000,
+    tile_id,
+    {mag_part},
+    {err_part},
+    flags[jpas::J0660] AS flags_J0660,
+    flags[jpas::iSDSS] AS flags_iSDSS,
+    mask_flags[jpas::J0660] AS mask_J0660,
+    mask_flags[jpas::iSDSS] AS mask_iSDSS,
+    class_star
+FROM
+    jpas.MagABDualObj
+WHERE {QUALITY_WHERE}
+    {extra_where}
+"""
+
+
+def magnitude_query(filters, min_mag, max_mag):
+    """Consulta de fotometría restringida a min_mag ≤ iSDSS < max_mag"""
+    return photometry_query(
+        filters,
+        extra_where=f"AND mag_aper_cor_6_0[jpas::iSDSS] >= {min_mag} "
+                    f"AND mag_aper_cor_6_0[jpas::iSDSS] < {max_mag}")
+
+
+def fetch_bins(service, filters, bins, max_queries=4):
+    """Descarga cada bin de magnitud con su propia consulta, en paralelo
+
+    Como mucho `max_queries` consultas a la vez contra el servidor. Genera
+    (i, min_mag, max_mag, tabla) según van terminando (i empieza en 1).
+    """
+    def run(min_mag, max_mag):
+        return clean_meta(service.run_async(magnitude_query(filters, min_mag, max_mag)).to_table())
+
+    with ThreadPoolExecutor(max_workers=max_queries) as pool:
+        futures = {pool.submit(run, min_mag, max_mag): (i, min_mag, max_mag)
+                   for i, (min_mag, max_mag) in enumerate(bins, start=1)}
+        for future in as_completed(futures):
+            i, min_mag, max_mag = futures[future]
+            yield i, min_mag, max_mag, future.result()
+
+
+def clean_meta(table):
+    """Limpia metadatos problemáticos antes de escribir a FITS"""
+    table.meta = {}
+    for col in table.columns:
+        if 'description' in table[col].meta:
+            del table[col].meta['description']
+    return table
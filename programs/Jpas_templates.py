@@ -0,0 +1,284 @@
+"""
+Ajuste de plantillas espectrales a las SEDs JPAS como operación de matrices
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, pandas
+
+Se calcula una sola vez la matriz de fotometría sintética T (plantillas ×
+filtros) integrando cada espectro plantilla con la transmisión de cada
+filtro: curvas reales si se dan en `--curves`, o filtros rectangulares
+(λ ± anchura/2 de JPAS-filters.csv). Después, para todos los objetos a la
+vez (por bloques), con pesos w = 1/σ² y flujos F:
+
+    a_k   = Σ w F T_k / Σ w T_k²                (normalización, ≥ 0)
+    χ²_k  = Σ w F² − (Σ w F T_k)² / Σ w T_k²
+
+que son tres productos de matrices (N × F)·(F × K). Se guarda la mejor
+plantilla, su clase (prefijo del nombre del fichero, p. ej. PN_NGC7027.dat
+→ PN), la normalización y el χ².
+
+Todas las plantillas se comparan sobre el mismo conjunto de filtros: los
+filtros que ninguna plantilla cubre se descartan, y una plantilla que no
+cubre algún filtro medido en un objeto recibe χ² = ∞ para ese objeto (si
+no, ganaría por sumar menos términos).
+
+Plantillas: ficheros .dat/.txt (λ[Å] f_λ), .csv (dos primeras columnas)
+o .fits (columnas wavelength/flux o las dos primeras).
+
+Ejemplo:
+    python Jpas_templates.py ../Halpha_emitters/Halpha_17_185.parquet -t ../templates \\
+        -f ../JPAS-filters.csv --curves ../filter_curves
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+
+from Jpas_halpha_ew import load_filters, mag_to_flux, BAD_MAG
+from Jpas_io import read_table, write_table
+
+TEMPLATE_EXT = (".dat", ".txt", ".csv", ".fits", ".fit")
+CURVE_SAMPLES = 200  # puntos por filtro al integrar
+
+# np.trapz pasó a llamarse np.trapezoid en NumPy 2
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+def read_spectrum(path):
+    """Longitud de onda (Å) y f_λ de una plantilla, ordenadas y finitas"""
+    if path.lower().endswith((".fits", ".fit")):
+        table = Table.read(path, hdu=1)
+        names = {n.lower(): n for n in table.colnames}
+        lam_col = names.get("wavelength", names.get("lambda", table.colnames[0]))
+        flux_col = names.get("flux", table.colnames[1])
+        lam, flux = np.asarray(table[lam_col], float), np.asarray(table[flux_col], float)
+    elif path.lower().endswith(".csv"):
+        data = pd.read_csv(path, comment="#")
+        lam, flux = data.iloc[:, 0].to_numpy(float), data.iloc[:, 1].to_numpy(float)
+    else:
+        data = np.loadtxt(path, comments="#", usecols=(0, 1))
+        lam, flux = data[:, 0], data[:, 1]
+    good = np.isfinite(lam) & np.isfinite(flux)
+    order = np.argsort(lam[good])
+    return lam[good][order], flux[good][order]
+
+
+def load_templates(template_dir):
+    """Diccionario nombre → (λ, f_λ) con todas las plantillas del directorio"""
+    paths = sorted(p for p in glob.glob(os.path.join(template_dir, "*"))
+                   if p.lower().endswith(TEMPLATE_EXT))
+    if not paths:
+        print(f"❌ No hay plantillas ({', '.join(TEMPLATE_EXT)}) en {template_dir}")
+        raise SystemExit(1)
+    return {os.path.splitext(os.path.basename(p))[0]: read_spectrum(p) for p in paths}
+
+
+def template_class(name):
+    """Clase de una plantilla: prefijo del nombre antes del primer '_'"""
+    return name.split("_", 1)[0]
+
+
+def filter_curves(filters, bands, curves_dir=None):
+    """Transmisión (λ, T) de cada filtro: curva de `curves_dir` o rectangular
+
+    Una curva se asocia al filtro cuyo nombre termina el del fichero
+    (J0660.dat, JPAS_J0660.tab, ...).
+    """
+    files = {}
+    if curves_dir:
+        for path in glob.glob(os.path.join(curves_dir, "*")):
+            stem = os.path.splitext(os.path.basename(path))[0].upper()
+            for band in bands:
+                if stem.endswith(band.upper()):
+                    files[band] = path
+    curves = {}
+    for band in bands:
+        if band in files:
+            data = np.loadtxt(files[band], comments="#", usecols=(0, 1))
+            lam = np.linspace(data[:, 0].min(), data[:, 0].max(), CURVE_SAMPLES)
+            curves[band] = (lam, np.clip(np.interp(lam, data[:, 0], data[:, 1]), 0, None))
+        else:
+            center, width = filters.loc[band, "wavelength"], filters.loc[band, "width"]
+            lam = np.linspace(center - width / 2, center + width / 2, CURVE_SAMPLES)
+            curves[band] = (lam, np.ones_like(lam))
+    return curves, sorted(files)
+
+
+def synthetic_matrix(templates, curves, bands, redshifts=(0.0,)):
+    """Matriz (K, F) de f_λ medio por filtro para cada plantilla y redshift
+
+    <f_λ> = ∫ f_λ T λ dλ / ∫ T λ dλ (detector de fotones). Los filtros que
+    la plantilla no cubre quedan en NaN y no entran en su χ².
+    """
+    rows, names = [], []
+    for name, (lam, flux) in templates.items():
+        for z in redshifts:
+            lam_obs, flux_obs = lam * (1 + z), flux / (1 + z)
+            row = np.full(len(bands), np.nan)
+            for j, band in enumerate(bands):
+                lam_f, trans = curves[band]
+                if lam_f[0] < lam_obs[0] or lam_f[-1] > lam_obs[-1]:
+                    continue
+                weight = trans * lam_f
+                row[j] = _trapezoid(np.interp(lam_f, lam_obs, flux_obs) * weight, lam_f) / \
+                    _trapezoid(weight, lam_f)
+            rows.append(row)
+            names.append((name, z))
+    return np.array(rows), names
+
+
+def observed_fluxes(df, filters, bands, zp=2.41, err_floor=0.0):
+    """Flujos y pesos (N × F); peso 0 para magnitudes no válidas"""
+    mags = df[[f"mag_{b.lower()}_cor" for b in bands]].to_numpy(dtype=np.float64, copy=True)
+    errs = df[[f"err_{b.lower()}_cor" for b in bands]].to_numpy(dtype=np.float64, copy=True)
+    bad = ~np.isfinite(mags) | ~np.isfinite(errs) | (mags >= BAD_MAG) | (errs <= 0)
+    mags[bad], errs[bad] = 0.0, 1.0
+    lam = filters.loc[bands, "wavelength"].to_numpy(dtype=np.float64)
+    flux, flux_err = mag_to_flux(mags, errs, lam[None, :], zp)
+    var = flux_err**2 + (err_floor * flux)**2
+    weights = np.where(bad, 0.0, 1.0 / var)
+    return np.where(bad, 0.0, flux), weights
+
+
+def fit_templates(flux, weights, T):
+    """Normalización y χ² de todas las plantillas para todos los objetos (N × K)
+
+    El χ² de una plantilla que no cubre algún filtro medido del objeto es
+    ∞: así todas las plantillas que compiten usan los mismos filtros.
+    """
+    covered = np.isfinite(T)
+    T0 = np.where(covered, T, 0.0)
+    measured = (weights > 0).astype(float)
+    wF = weights * flux
+    A = wF @ T0.T                               # Σ w F T_k
+    B = weights @ (T0**2).T                     # Σ w T_k²
+    C = (wF * flux).sum(axis=1)[:, None]        # Σ w F² (todos los filtros medidos)
+    n_used = measured @ covered.T.astype(float)
+    missed = measured @ (~covered).T.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm = np.clip(A / B, 0.0, None)
+        chi2 = C - 2 * norm * A + norm**2 * B
+    chi2[(n_used < 2) | (missed > 0)] = np.inf
+    return norm, chi2, n_used - 1
+
+
+def covered_bands(T):
+    """Máscara de los filtros que cubre al menos una plantilla"""
+    return np.isfinite(T).any(axis=0)
+
+
+def classify(df, filters, bands, T, names, zp=2.41, err_floor=0.0, chunk_size=50000,
+             keep_chi2=False):
+    """Columnas de la mejor plantilla para todas las filas de `df`, por bloques"""
+    multi_z = len({z for _, z in names}) > 1
+    labels = [f"{n}@z{z:g}" if multi_z else n for n, z in names]
+    columns = ["template_best", "template_class", "template_norm", "template_chi2",
+               "template_ndof", "template_delta_chi2", "template_chi2_red"]
+    if multi_z:
+        columns.insert(1, "template_z")
+    if keep_chi2:
+        columns += [f"chi2_{l}" for l in labels]
+    parts = []
+    for start in range(0, len(df), chunk_size):
+        block = df.iloc[start:start + chunk_size]
+        flux, weights = observed_fluxes(block, filters, bands, zp, err_floor)
+        norm, chi2, ndof = fit_templates(flux, weights, T)
+        rows = np.arange(len(block))
+        order = np.argsort(chi2, axis=1)
+        best, second = order[:, 0], order[:, min(1, len(names) - 1)]
+        # Sin ninguna plantilla que cubra todos sus filtros medidos: sin clase
+        fitted = np.isfinite(chi2[rows, best])
+        out = pd.DataFrame({
+            "template_best": [names[k][0] if ok else None for k, ok in zip(best, fitted)],
+            "template_class": [template_class(names[k][0]) if ok else None
+                               for k, ok in zip(best, fitted)],
+            "template_norm": norm[rows, best],
+            "template_chi2": chi2[rows, best],
+            "template_ndof": ndof[rows, best].astype(int),
+            "template_delta_chi2": chi2[rows, second] - chi2[rows, best],
+        }, index=block.index)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out["template_chi2_red"] = out["template_chi2"] / out["template_ndof"]
+        out.loc[~fitted, "template_norm"] = np.nan
+        if multi_z:
+            out.insert(1, "template_z", [names[k][1] if ok else np.nan
+                                         for k, ok in zip(best, fitted)])
+        if keep_chi2:
+            out = pd.concat([out, pd.DataFrame(chi2, index=block.index,
+                                               columns=[f"chi2_{l}" for l in labels])], axis=1)
+        parts.append(out)
+    return pd.concat(parts) if parts else pd.DataFrame(columns=columns, index=df.index)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ajuste vectorizado de plantillas espectrales a las SEDs JPAS",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", help="Tabla de candidatos (CSV/Parquet/FITS)")
+    parser.add_argument("-t", "--templates", required=True,
+                        help="Directorio de plantillas (clase = prefijo del nombre, p. ej. PN_*)")
+    parser.add_argument("-f", "--filters", default="../JPAS-filters.csv",
+                        help="Archivo CSV de definición de filtros (wavelength, width)")
+    parser.add_argument("--curves", default=None,
+                        help="Directorio con curvas de transmisión (λ, T) por filtro")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Salida (por defecto <entrada>_templates con la misma extensión)")
+    parser.add_argument("--redshift", type=float, nargs="*", default=[0.0],
+                        help="Redshifts a los que se desplazan las plantillas")
+    parser.add_argument("--exclude", nargs="*", default=[],
+                        help="Filtros que no entran en el ajuste")
+    parser.add_argument("--err_floor", type=float, default=0.02,
+                        help="Error sistemático relativo añadido en cuadratura al flujo")
+    parser.add_argument("--zp", type=float, default=2.41,
+                        help="Zero point para conversión de magnitud")
+    parser.add_argument("--chunk_size", type=int, default=50000,
+                        help="Objetos por bloque")
+    parser.add_argument("--all_chi2", action="store_true",
+                        help="Guardar el χ² de todas las plantillas (columnas chi2_*)")
+
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+
+    df = read_table(args.input)
+    filters = load_filters(args.filters)
+    bands = [b for b in filters.index
+             if b not in args.exclude and f"mag_{b.lower()}_cor" in df.columns]
+    templates = load_templates(args.templates)
+    curves, with_curve = filter_curves(filters, bands, args.curves)
+    T, names = synthetic_matrix(templates, curves, bands, args.redshift)
+    keep = covered_bands(T)
+    if not keep.all():
+        print(f"Filtros sin ninguna plantilla que los cubra (se descartan): "
+              f"{', '.join(b for b, k in zip(bands, keep) if not k)}")
+        bands, T = [b for b, k in zip(bands, keep) if k], T[:, keep]
+    if not bands:
+        print("❌ Ninguna plantilla cubre los filtros de la tabla")
+        raise SystemExit(1)
+    print(f"Matriz sintética: {len(names)} plantillas × {len(bands)} filtros "
+          f"({len(with_curve)} con curva real) en {time.perf_counter() - t0:.2f} s")
+
+    t1 = time.perf_counter()
+    fits = classify(df, filters, bands, T, names, args.zp, args.err_floor, args.chunk_size,
+                    args.all_chi2)
+    print(f"{len(df)} objetos ajustados en {time.perf_counter() - t1:.2f} s")
+    n_unfit = int(fits["template_class"].isna().sum())
+    if n_unfit:
+        print(f"  Sin plantilla que cubra todos sus filtros: {n_unfit}")
+    for cls, n in fits["template_class"].value_counts().items():
+        print(f"  {cls:<16} {n}")
+
+    result = pd.concat([df, fits], axis=1)
+    stem, ext = os.path.splitext(args.input)
+    output = args.output or f"{stem}_templates{ext}"
+    write_table(result, output)
+    print(f"\n✅ {len(result)} objetos guardados en:")
+    print(f"📄 {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+Proceso residente (worker) para ejecutar trabajos JPAS sin recargar módulos
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+ (el servidor necesita además astropy, pandas, matplotlib, pyvo)
+
+El servidor importa una sola vez astropy.modeling, pandas y matplotlib
+(con el estilo de Jpas_SED.py), mantiene la sesión TAP autenticada, el
+registro de filtros y una caché LRU de bins cargados, y atiende trabajos
+select / sed / download por un socket UNIX local. El cliente sólo importa
+la biblioteca estándar, por lo que cada trabajo corto tarda milisegundos.
+
+Ejemplos:
+    python Jpas_worker.py serve --login -f ../JPAS-filters.csv &
+    python Jpas_worker.py submit select ../Data/jpas_bin_3_17.5to18.5i.fits -o ../Halpha_emitters/h3.parquet
+    python Jpas_worker.py submit sed ../Halpha_emitters/h3.parquet -o ../jpas_seds
+    python Jpas_worker.py submit download --bins 13 16 17.5 -o ../Data
+    python Jpas_worker.py submit download --plan ../Data/shard_plan.json -o ../Data
+    python Jpas_worker.py status
+    python Jpas_worker.py shutdown
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"),
+                              f"jpas_worker_{os.getuid()}.sock")
+
+
+# ======================================================================
+# Servidor
+# ======================================================================
+class _ThreadStdout(io.TextIOBase):
+    """sys.stdout que envía lo que escribe cada hilo a su propio buffer
+
+    Los trabajos corren en hilos distintos del servidor; redirigir el
+    stdout global mezclaría sus salidas (y la del propio servidor).
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, "buffer", None) or self.default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    @contextmanager
+    def capture(self):
+        """Captura en un StringIO la salida del hilo actual"""
+        self.local.buffer = log = io.StringIO()
+        try:
+            yield log
+        finally:
+            self.local.buffer = None
+
+
+class WorkerState:
+    """Estado caliente del worker: módulos, sesión TAP, filtros y bins en caché"""
+
+    def __init__(self, filter_file=None, cache_bins=4, release=None, login=False, max_jobs=1):
+        t0 = time.perf_counter()
+        import Selecting_halpha
+        import Jpas_SED
+        import Jpas_io
+        self.selecting = Selecting_halpha
+        self.sed = Jpas_SED
+        self.io = Jpas_io
+        self.filter_file = os.path.abspath(filter_file) if filter_file else None
+        self.filters = Jpas_SED.load_jpas_filters(self.filter_file) if filter_file else None
+        self.cache_bins = cache_bins
+        self.bins = OrderedDict()
+        self.release = release
+        self.service = None
+        if login:
+            import Jpas_tap
+            self.service = Jpas_tap.login(release or Jpas_tap.DEFAULT_RELEASE)
+        self.started = time.time()
+        self.jobs_done = 0
+        self.running = {}
+        # lock: sólo contabilidad y cachés; slots: trabajos pesados simultáneos
+        self.lock = threading.Lock()
+        # Agg es reentrante por figura, pero el texto matemático comparte cachés
+        self.render_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+        self.stdout = sys.stdout
+        print(f"Worker listo en {time.perf_counter() - t0:.2f} s")
+
+    def load_bin(self, path):
+        """Tabla (FITS/Parquet/CSV) con caché LRU por (ruta, mtime)"""
+        key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            if key in self.bins:
+                self.bins.move_to_end(key)
+                return self.bins[key]
+        # La lectura se hace sin el lock: no bloquea status ni otros trabajos
+        if path.lower().endswith((".fits", ".fit")) or self.io.table_format(path) == "shards":
+            df = self.selecting.load_data(path)
+        else:
+            df = self.io.read_table(path)
+        with self.lock:
+            self.bins[key] = df
+            while len(self.bins) > self.cache_bins:
+                self.bins.popitem(last=False)
+        return df
+
+    # ------------------------------------------------------------------
+    def job_select(self, input, output, variance_method="Fratta", sigma_threshold=5.0):
+        sel = self.selecting
+        df = sel.compute_colors(sel.apply_quality_cuts(self.load_bin(input)))
+        final_df = sel.select_candidates(df, variance_method, sigma_threshold)
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        self.io.write_table(final_df, output)
+        print(f"{len(final_df)} candidatos guardados en {output}")
+        return {"candidates": len(final_df), "output": output}
+
+    def job_sed(self, input, output, zp=2.41, filters=None, numbers=None):
+        if filters and filters != self.filter_file:
+            registry = self.sed.load_jpas_filters(filters)
+            with self.lock:
+                self.filter_file, self.filters = filters, registry
+        else:
+            registry = self.filters
+        if registry is None:
+            raise ValueError("No hay registro de filtros: use serve -f o sed --filters")
+        df = self.load_bin(input)
+        if numbers:
+            df = df[df["number"].isin(numbers)]
+        os.makedirs(output, exist_ok=True)
+        success = 0
+        for idx, row in df.iterrows():
+            try:
+                with self.render_lock:
+                    self.sed.create_sed_plot(row, registry, output, zp)
+                success += 1
+            except Exception as e:
+                print(f"❌ Error en fila {idx}: {str(e)}")
+        print(f"{success}/{len(df)} SEDs generados en {output}")
+        return {"seds": success, "output": output}
+
+    def job_download(self, output, bins, filters="all", shards=None, max_queries=4,
+                     rows_per_part=250000):
+        import Jpas_tap
+        if self.service is None:
+            raise ValueError("El worker no tiene sesión TAP: inicie con serve --login")
+        if len(bins) < 2:
+            raise ValueError("Se necesitan al menos dos bordes de bin")
+        band_list = Jpas_tap.ALL_FILTERS if filters == "all" else Jpas_tap.HALPHA_FILTERS
+        os.makedirs(output, exist_ok=True)
+        written = {}
+        # Una consulta por bin, como mucho max_queries a la vez
+        for i, min_mag, max_mag, table in Jpas_tap.fetch_bins(
+                self.service, band_list, list(zip(bins[:-1], bins[1:])), max_queries):
+            filename = os.path.join(output, f"jpas_bin_{i}_{min_mag}to{max_mag}i.fits")
+            if shards:
+                filename = filename[:-len(".fits")] + ".shards"
+                self.io.write_sharded(table, filename, rows_per_part=rows_per_part,
+                                     part_format=shards)
+            else:
+                table.write(filename, overwrite=True, format='fits')
+            print(f"Bin {i} ({min_mag} ≤ i < {max_mag}): {len(table)} objetos guardados en {filename}")
+            written[i] = filename
+        return {"files": [written[i] for i in sorted(written)]}
+
+    def job_status(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "uptime_s": round(time.time() - self.started, 1),
+                "jobs_done": self.jobs_done,
+                "running": sorted(self.running.values()),
+                "cached_bins": [k[0] for k in self.bins],
+                "filters": self.filter_file,
+                "tap_session": self.service is not None,
+            }
+
+    def run(self, request):
+        """Ejecuta un trabajo capturando su salida
+
+        Los trabajos pesados esperan a un hueco (max_jobs); status no espera
+        y el lock sólo protege la contabilidad y las cachés.
+        """
+        job = request.get("job")
+        handler = getattr(self, f"job_{job}", None)
+        if handler is None:
+            return {"ok": False, "error": f"Trabajo desconocido: {job}"}
+        if job == "status":
+            return {"ok": True, "result": handler(), "log": "", "elapsed_s": 0.0}
+        t0 = time.perf_counter()
+        with self.slots, self.stdout.capture() as log:
+            with self.lock:
+                self.running[threading.get_ident()] = job
+            try:
+                result = handler(**request.get("args", {}))
+                response = {"ok": True, "result": result}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            finally:
+                with self.lock:
+                    del self.running[threading.get_ident()]
+                    self.jobs_done += 1
+        response["log"] = log.getvalue()
+        response["elapsed_s"] = round(time.perf_counter() - t0, 4)
+        return response
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            response = {"ok": False, "error": f"Petición inválida: {e}"}
+        else:
+            if request.get("job") == "shutdown":
+                response = {"ok": True, "result": "apagando"}
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                response = self.server.state.run(request)
+        self.wfile.write((json.dumps(response, default=str) + "\n").encode())
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        try:
+            request({"job": "status"}, args.socket)
+            print(f"❌ Ya hay un worker escuchando en {args.socket}")
+            raise SystemExit(1)
+        except OSError:
+            os.remove(args.socket)  # socket huérfano de una ejecución anterior
+
+    state = WorkerState(args.filters, args.cache_bins, args.release, args.login, args.max_jobs)
+    # El socket se crea ya con permisos 0600: ningún otro usuario puede
+    # conectarse entre bind() y un chmod posterior
+    old_umask = os.umask(0o077)
+    try:
+        server = _Server(args.socket, _Handler)
+    finally:
+        os.umask(old_umask)
+    server.state = state
+    print(f"🔌 Worker escuchando en {args.socket} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        print("Worker detenido")
+
+
+# ======================================================================
+# Cliente
+# ======================================================================
+def request(payload, socket_path=DEFAULT_SOCKET, timeout=None):
+    """Envía un trabajo al worker y devuelve la respuesta"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(payload) + "\n").encode())
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def submit(args):
+    if args.job == "select":
+        job_args = {"input": os.path.abspath(args.input),
+                    "output": os.path.abspath(args.output),
+                    "variance_method": args.variance_method,
+                    "sigma_threshold": args.sigma_threshold}
+    elif args.job == "sed":
+        job_args = {"input": os.path.abspath(args.input),
+                    "output": os.path.abspath(args.output), "zp": args.zp}
+        if args.filters:
+            job_args["filters"] = os.path.abspath(args.filters)
+        if args.numbers:
+            job_args["numbers"] = args.numbers
+    else:
+        bins = args.bins
+        if args.plan:
+            from Jpas_bins import load_plan
+            plan = load_plan(args.plan)
+            bins = [lo for lo, _ in plan] + [plan[-1][1]]
+        job_args = {"output": os.path.abspath(args.output), "bins": bins,
+                    "filters": args.filter_set, "shards": args.shards,
+                    "max_queries": args.max_queries, "rows_per_part": args.rows_per_part}
+
+    try:
+        response = request({"job": args.job, "args": job_args}, args.socket)
+    except OSError as e:
+        print(f"❌ No se pudo conectar con el worker en {args.socket}: {e}")
+        raise SystemExit(1)
+    sys.stdout.write(response.get("log", ""))
+    if not response["ok"]:
+        print(f"❌ {response['error']}")
+        raise SystemExit(1)
+    print(f"✅ {args.job} completado en {response['elapsed_s']} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Worker residente para trabajos JPAS (select/sed/download)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Socket UNIX del worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_serve = sub.add_parser("serve", help="Iniciar el worker")
+    p_serve.add_argument("-f", "--filters", default=None,
+                         help="Archivo CSV de definición de filtros (para SEDs)")
+    p_serve.add_argument("--cache_bins", type=int, default=4,
+                         help="Número de bins que se mantienen en memoria")
+    p_serve.add_argument("--login", action="store_true",
+                         help="Iniciar sesión TAP (CEFCA) al arrancar, para trabajos download")
+    p_serve.add_argument("--release", default=None, help="Data release para la sesión TAP")
+    p_serve.add_argument("--max_jobs", type=int, default=1,
+                         help="Trabajos ejecutándose a la vez (status nunca espera)")
+
+    p_submit = sub.add_parser("submit", help="Enviar un trabajo")
+    jobs = p_submit.add_subparsers(dest="job", required=True)
+
+    j_sel = jobs.add_parser("select", help="Selección Hα (Selecting_halpha.py)")
+    j_sel.add_argument("input")
+    j_sel.add_argument("-o", "--output", required=True)
+    j_sel.add_argument("--variance_method", choices=["Maguio", "Mine", "Fratta"], default="Fratta")
+    j_sel.add_argument("--sigma_threshold", type=float, default=5.0)
+
+    j_sed = jobs.add_parser("sed", help="SEDs (Jpas_SED.py)")
+    j_sed.add_argument("input")
+    j_sed.add_argument("-o", "--output", required=True)
+    j_sed.add_argument("-f", "--filters", default=None)
+    j_sed.add_argument("--zp", type=float, default=2.41)
+    j_sed.add_argument("--numbers", type=int, nargs="+", default=None,
+                       help="Sólo estos objetos (columna number)")
+
+    j_dl = jobs.add_parser("download", help="Descarga por bins de magnitud iSDSS")
+    j_bins = j_dl.add_mutually_exclusive_group(required=True)
+    j_bins.add_argument("--bins", type=float, nargs="+",
+                        help="Bordes de los bins, p. ej. 13 16 17.5 18.5")
+    j_bins.add_argument("--plan", default=None,
+                        help="Plan de bins de igual número de objetos (Jpas_bins.py)")
+    j_dl.add_argument("-o", "--output", default="Data")
+    j_dl.add_argument("--filter_set", choices=["all", "halpha"], default="all")
+    j_dl.add_argument("--shards", choices=["fits.gz", "parquet"], default=None,
+                      help="Guardar cada bin como directorio .shards de partes comprimidas")
+    j_dl.add_argument("--rows_per_part", type=int, default=250000,
+                      help="Filas por parte con --shards")
+    j_dl.add_argument("--max_queries", type=int, default=4,
+                      help="Consultas TAP simultáneas (una por bin)")
+
+    sub.add_parser("status", help="Estado del worker")
+    sub.add_parser("shutdown", help="Detener el worker")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "submit":
+        submit(args)
+    else:
+        try:
+            response = request({"job": args.command}, args.socket)
+        except OSError as e:
+            print(f"❌ No se pudo conectar con el worker en {args.socket}: {e}")
+            raise SystemExit(1)
+        print(json.dumps(response.get("result", response), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Cross-match local de candidatos Hα con un catálogo de referencia (Gaia DR3)
+Autor: Luis A. Gutiérrez Soto
+Requisitos: Python 3.8+, astropy, numpy, pandas, scipy (pyarrow para Parquet)
+
+Barrido en declinación: candidatos y referencia se ordenan por Dec, los
+candidatos se procesan en bloques contiguos y para cada bloque sólo se
+indexa la franja de la referencia que lo cubre (+ radio de búsqueda).
+Los bloques se procesan en paralelo y todo funciona sin conexión.
+
+Ejemplo:
+    python Jpas_xmatch.py ../Halpha_emitters/Halpha_17_185.csv gaia_dr3_jpas.parquet \\
+        -o ../Halpha_emitters/Halpha_17_185_gaia.csv --radius 1.5 --class_star_max 0.2
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from Jpas_index import radec_to_xyz, arcsec_to_chord, chord_to_arcsec
+from Jpas_io import read_table, write_table
+
+# Columnas de Gaia que se añaden (si existen) con el prefijo "gaia_"
+GAIA_COLUMNS = ["source_id", "parallax", "parallax_error", "pmra", "pmdec",
+                "phot_g_mean_mag", "phot_bp_mean_mag", "phot_rp_mean_mag", "ruwe"]
+
+
+def _resolve(df, *names):
+    """Devuelve el primer nombre de columna existente (sin distinguir mayúsculas)"""
+    lower = {c.lower(): c for c in df.columns}
+    for n in names:
+        if n.lower() in lower:
+            return lower[n.lower()]
+    raise KeyError(f"Ninguna de las columnas {names} está en la tabla")
+
+
+def _match_block(cand_xyz, cand_dec, ref_xyz, ref_dec_sorted, chord, pad_deg):
+    """Empareja un bloque de candidatos contra la franja de referencia que lo cubre"""
+    lo = np.searchsorted(ref_dec_sorted, cand_dec.min() - pad_deg, side="left")
+    hi = np.searchsorted(ref_dec_sorted, cand_dec.max() + pad_deg, side="right")
+    idx = np.full(len(cand_dec), -1, dtype=np.int64)
+    sep = np.full(len(cand_dec), np.nan)
+    n_match = np.zeros(len(cand_dec), dtype=np.int32)
+    if hi <= lo:
+        return idx, sep, n_match
+
+    tree = cKDTree(ref_xyz[lo:hi])
+    d, j = tree.query(cand_xyz, k=1, distance_upper_bound=chord)
+    ok = np.isfinite(d)
+    idx[ok] = j[ok] + lo
+    sep[ok] = chord_to_arcsec(d[ok])
+    # Número de fuentes de referencia dentro del radio (blending / ambigüedad)
+    n_match[ok] = [len(x) for x in tree.query_ball_point(cand_xyz[ok], chord)]
+    return idx, sep, n_match
+
+
+def crossmatch(candidates, reference, radius_arcsec=1.0, chunk_size=200000, workers=None):
+    """Cross-match posicional por barrido en declinación
+
+    Devuelve `candidates` con las columnas gaia_* añadidas, gaia_sep_arcsec
+    y gaia_n_match (0 si no hay contrapartida dentro del radio).
+    """
+    c_ra, c_dec = _resolve(candidates, "alpha_j2000", "ra"), _resolve(candidates, "delta_j2000", "dec")
+    r_ra, r_dec = _resolve(reference, "ra", "alpha_j2000"), _resolve(reference, "dec", "delta_j2000")
+
+    # Ordenar ambos catálogos por declinación
+    ref_order = np.argsort(reference[r_dec].values, kind="stable")
+    ref_dec_sorted = reference[r_dec].values[ref_order].astype(np.float64)
+    ref_xyz = radec_to_xyz(reference[r_ra].values[ref_order], ref_dec_sorted)
+
+    cand_order = np.argsort(candidates[c_dec].values, kind="stable")
+    cand_dec = candidates[c_dec].values[cand_order].astype(np.float64)
+    cand_xyz = radec_to_xyz(candidates[c_ra].values[cand_order], cand_dec)
+
+    chord = float(arcsec_to_chord(radius_arcsec))
+    pad_deg = radius_arcsec / 3600.0
+    starts = range(0, len(cand_dec), chunk_size)
+
+    def run(start):
+        stop = start + chunk_size
+        return _match_block(cand_xyz[start:stop], cand_dec[start:stop],
+                            ref_xyz, ref_dec_sorted, chord, pad_deg)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, starts))
+
+    if results:
+        idx_sorted = np.concatenate([r[0] for r in results])
+        sep_sorted = np.concatenate([r[1] for r in results])
+        n_sorted = np.concatenate([r[2] for r in results])
+    else:
+        idx_sorted = np.empty(0, dtype=np.int64)
+        sep_sorted = np.empty(0)
+        n_sorted = np.empty(0, dtype=np.int32)
+
+    # Deshacer el orden por declinación
+    ref_idx = np.empty_like(idx_sorted)
+    ref_idx[cand_order] = idx_sorted
+    sep = np.empty_like(sep_sorted)
+    sep[cand_order] = sep_sorted
+    n_match = np.empty_like(n_sorted)
+    n_match[cand_order] = n_sorted
+
+    out = candidates.copy()
+    matched = ref_idx >= 0
+    ref_rows = np.where(matched, ref_order[np.clip(ref_idx, 0, None)], 0)
+    lower_ref = {c.lower(): c for c in reference.columns}
+    for col in GAIA_COLUMNS:
+        if col not in lower_ref:
+            continue
+        values = reference[lower_ref[col]].values[ref_rows]
+        if col == "source_id":
+            out["gaia_source_id"] = np.where(matched, values, -1).astype(np.int64)
+        else:
+            out[f"gaia_{col}"] = np.where(matched, values.astype(np.float64), np.nan)
+    out["gaia_sep_arcsec"] = sep
+    out["gaia_n_match"] = n_match
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cross-match local de candidatos JPAS con un catálogo tipo Gaia DR3",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("candidates", help="Tabla de candidatos (CSV/FITS/Parquet)")
+    parser.add_argument("reference", help="Catálogo de referencia local (Parquet/FITS/CSV)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Archivo de salida (por defecto <candidatos>_gaia con la misma extensión)")
+    parser.add_argument("--radius", type=float, default=1.0,
+                        help="Radio de búsqueda en arcsec")
+    parser.add_argument("--chunk_size", type=int, default=200000,
+                        help="Candidatos por bloque del barrido")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Hilos en paralelo (por defecto, según CPUs)")
+    parser.add_argument("--class_star_max", type=float, default=None,
+                        help="Corte morfológico opcional: conservar class_star < valor")
+    parser.add_argument("--drop_matched", action="store_true",
+                        help="Eliminar candidatos con contrapartida en la referencia")
+
+    args = parser.parse_args()
+
+    print(f"\nCargando candidatos desde: {args.candidates}")
+    candidates = read_table(args.candidates)
+    print(f"Cargando referencia desde: {args.reference}")
+    reference = read_table(args.reference)
+    print(f"{len(candidates)} candidatos vs {len(reference)} fuentes de referencia")
+
+    result = crossmatch(candidates, reference, args.radius, args.chunk_size, args.workers)
+    n_matched = int((result["gaia_n_match"] > 0).sum())
+    print(f"Contrapartidas dentro de {args.radius}\": {n_matched}")
+
+    if args.class_star_max is not None:
+        result = result[result[_resolve(result, "class_star")] < args.class_star_max]
+        print(f"Tras corte class_star < {args.class_star_max}: {len(result)}")
+    if args.drop_matched:
+        result = result[result["gaia_n_match"] == 0]
+        print(f"Tras eliminar contrapartidas: {len(result)}")
+
+    stem, ext = os.path.splitext(args.candidates)
+    output = args.output or f"{stem}_gaia{ext}"
+    write_table(result, output, float_format=None)
+    print(f"\n✅ {len(result)} candidatos guardados en:")
+    print(f"📄 {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
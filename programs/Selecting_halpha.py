@@ -14,6 +14,311 @@ from astropy.stats import sigma_clip
 from astropy.modeling import models, fitting
 import argparse
 import os
+import pickle
+import shutil
+import tempfile
+
+from Jpas_io import TableWriter, iter_table_chunks, read_sharded, table_format, write_table
+from Jpas_profiling import StageProfiler, run_profiler
+
+# Perfilador desactivado (no mide nada) para las llamadas sin --profile
+NO_PROFILE = StageProfiler(enabled=False)
+
+# Configuración de filtros para pseudo-r
+R_BANDS = ['mag_j0600_cor', 'mag_j0610_cor', 'mag_j0620_cor',
+           'mag_j0630_cor', 'mag_j0640_cor', 'mag_j0650_cor']
+R_ERRORS = ['err_j0600_cor', 'err_j0610_cor', 'err_j0620_cor',
+            'err_j0630_cor', 'err_j0640_cor', 'err_j0650_cor']
+
+# Filtros de calidad JPAS
+QUALITY_QUERY = (
+    "flags_j0660 <= 3 and "
+    "mask_j0660 == 0 and "
+    "flags_isdss <= 3 and "
+    "mask_isdss == 0"
+)
+
+
+def load_data(input_fits, profiler=NO_PROFILE):
+    """Carga el archivo FITS de JPAS (o su versión particionada .shards) como DataFrame"""
+    if table_format(input_fits) == "shards":
+        with profiler.stage("read_shards") as rec:
+            df = read_sharded(input_fits)
+            rec["rows"] = len(df)
+        return df
+    with profiler.stage("read_fits") as rec:
+        with fits.open(input_fits, memmap=False) as hdul:
+            data = hdul[1].data
+        rec["rows"] = len(data)
+    with profiler.stage("to_pandas", rows=len(data)):
+        return Table(data).to_pandas()
+
+
+def apply_quality_cuts(df):
+    """Aplica los filtros de calidad JPAS"""
+    return df.query(QUALITY_QUERY)
+
+
+def compute_colors(df):
+    """Calcula pseudo-r, colores y sus errores"""
+    # Calcular pseudo-r con promedio ponderado por SNR²
+    weights = 1 / (df[R_ERRORS].values**2)
+    df['pseudo_r'] = np.average(df[R_BANDS].values, axis=1, weights=weights)
+    df['e_pseudo_r'] = np.sqrt(1 / np.sum(weights, axis=1))
+    
+    # Calcular colores y errores
+    df['color_x'] = df['pseudo_r'] - df['mag_isdss_cor']  # pseudo-r - iSDSS
+    df['color_y'] = df['pseudo_r'] - df['mag_j0660_cor']  # pseudo-r - J0660
+    
+    df['e_color_x'] = np.sqrt(df['e_pseudo_r']**2 + df['err_isdss_cor']**2)
+    df['e_color_y'] = np.sqrt(df['e_pseudo_r']**2 + df['err_j0660_cor']**2)
+    return df
+
+
+def fit_tile_locus(tile_data):
+    """Ajusta el locus estelar de un tile con sigma-clipping (4σ, 5 iteraciones)"""
+    fitter = fitting.LinearLSQFitter()
+    model = models.Linear1D()
+    
+    fitted_model, mask = fitting.FittingWithOutlierRemoval(
+        fitter, 
+        sigma_clip, 
+        sigma=4.0, 
+        niter=5
+    )(model, tile_data['color_x'], tile_data['color_y'])
+    return fitted_model, mask
+
+
+def compute_variance(variance_method, sigma_int, m, e_color_x, e_color_y, err_j0660):
+    """Varianza total del residuo según el método elegido"""
+    if variance_method == "Maguio":
+        return (
+            sigma_int**2 + 
+            m**2 * e_color_x**2 + 
+            (1 - m)**2 * e_color_y**2 +
+            err_j0660**2
+        )
+    elif variance_method == "Mine":
+        return (
+            sigma_int**2 +
+            m**2 * e_color_x**2 +
+            (1 - m)**2 * e_color_y**2
+        )
+    else:  # Fratta
+        return (
+            sigma_int**2 + 
+            m**2 * e_color_x**2 + 
+            e_color_y**2
+        )
+
+
+def tile_threshold(tile_data, variance_method, sigma_threshold):
+    """Locus del tile, residuos y umbral de selección por objeto"""
+    # A. Ajuste del locus estelar
+    fitted_model, mask = fit_tile_locus(tile_data)
+    
+    # B. Calcular parámetros clave
+    residuals = tile_data['color_y'] - fitted_model(tile_data['color_x'])
+    sigma_int = np.std(residuals[mask])
+    m = fitted_model.slope.value
+    b = fitted_model.intercept.value
+    
+    # C. Calcular varianza total
+    var = compute_variance(variance_method, sigma_int, m,
+                           tile_data['e_color_x'], tile_data['e_color_y'],
+                           tile_data['err_j0660_cor'])
+    threshold = sigma_threshold * np.sqrt(var)
+    return residuals, threshold, m, b, sigma_int
+
+
+def select_tile(tile_id, tile_data, variance_method, sigma_threshold):
+    """Selecciona los candidatos Hα de un tile"""
+    residuals, threshold, m, b, sigma_int = tile_threshold(
+        tile_data, variance_method, sigma_threshold)
+    
+    # D. Seleccionar candidatos
+    ha_mask = residuals >= threshold
+    candidates = tile_data[ha_mask].copy()
+    
+    # Añadir metadatos del ajuste
+    candidates['slope'] = m
+    candidates['intercept'] = b
+    candidates['sigma_int'] = sigma_int
+    candidates['tile_id'] = tile_id
+    return candidates
+
+
+def selection_probability(tile_data, m, b, threshold, n_draws, chunk_rows, rng):
+    """Fracción de K realizaciones en que cada objeto supera el umbral
+
+    Las magnitudes se perturban con sus errores (err_*) y, para cada
+    realización, se recalculan pseudo-r, colores y residuos respecto al
+    locus del tile, como operaciones (K × N) por bloques de `chunk_rows`.
+    """
+    R = tile_data[R_BANDS].to_numpy(dtype=np.float32)
+    eR = tile_data[R_ERRORS].to_numpy(dtype=np.float32)
+    w = 1 / eR.astype(np.float64)**2
+    wn = (w / w.sum(axis=1, keepdims=True)).astype(np.float32)
+    pr0 = (R * wn).sum(axis=1)
+    ewn = eR * wn
+    mag_i = tile_data['mag_isdss_cor'].to_numpy(dtype=np.float32)
+    err_i = tile_data['err_isdss_cor'].to_numpy(dtype=np.float32)
+    mag_h = tile_data['mag_j0660_cor'].to_numpy(dtype=np.float32)
+    err_h = tile_data['err_j0660_cor'].to_numpy(dtype=np.float32)
+    thr = np.asarray(threshold, dtype=np.float32)
+
+    counts = np.zeros(len(tile_data), dtype=np.int64)
+    for start in range(0, len(tile_data), chunk_rows):
+        sl = slice(start, start + chunk_rows)
+        n = len(pr0[sl])
+        # pseudo-r perturbado = promedio ponderado de las bandas perturbadas
+        z_r = rng.standard_normal((n_draws, n, len(R_BANDS)), dtype=np.float32)
+        pseudo_r = pr0[sl] + np.einsum('knj,nj->kn', z_r, ewn[sl])
+        mi = mag_i[sl] + err_i[sl] * rng.standard_normal((n_draws, n), dtype=np.float32)
+        mh = mag_h[sl] + err_h[sl] * rng.standard_normal((n_draws, n), dtype=np.float32)
+        color_x = pseudo_r - mi
+        color_y = pseudo_r - mh
+        residuals = color_y - (b + m * color_x)
+        counts[sl] = (residuals >= thr[sl]).sum(axis=0)
+    return counts / n_draws
+
+
+def probability_tile(tile_id, tile_data, variance_method, sigma_threshold,
+                     n_draws=200, chunk_rows=2000, seed=0, min_prob=0.01):
+    """Probabilidad de selección Monte Carlo de los objetos de un tile"""
+    residuals, threshold, m, b, sigma_int = tile_threshold(
+        tile_data, variance_method, sigma_threshold)
+    rng = np.random.default_rng([seed, int(tile_id)])
+    p_select = selection_probability(tile_data, m, b, threshold, n_draws, chunk_rows, rng)
+    selected = (residuals >= threshold).to_numpy()
+
+    keep = (p_select >= min_prob) | selected
+    candidates = tile_data[keep].copy()
+    candidates['p_select'] = p_select[keep]
+    candidates['selected'] = selected[keep]
+    candidates['slope'] = m
+    candidates['intercept'] = b
+    candidates['sigma_int'] = sigma_int
+    candidates['tile_id'] = tile_id
+    return candidates
+
+
+def score_tile(tile_id, tile_data, variance_method, sigma_threshold, mc=None):
+    """Corte duro (select_tile) o probabilidad Monte Carlo (probability_tile) de un tile"""
+    if mc:
+        return probability_tile(tile_id, tile_data, variance_method, sigma_threshold, **mc)
+    return select_tile(tile_id, tile_data, variance_method, sigma_threshold)
+
+
+def select_candidates(df, variance_method="Fratta", sigma_threshold=5.0, profiler=NO_PROFILE,
+                      mc=None):
+    """Procesa todos los tiles y devuelve los candidatos consolidados
+
+    Con `mc` (dict de argumentos de probability_tile) se estima además la
+    probabilidad de selección Monte Carlo de cada objeto.
+    """
+    all_candidates = []
+    for tile_id, tile_data in df.groupby('tile_id'):
+        with profiler.stage("select_tile", tile=tile_id, rows=len(tile_data)):
+            all_candidates.append(
+                score_tile(tile_id, tile_data, variance_method, sigma_threshold, mc)
+            )
+    final_df = pd.concat(all_candidates, ignore_index=True)
+    
+    # Ordenar columnas: originales primero, nuevas al final
+    original_columns = df.columns.tolist()
+    new_columns = list(final_df.columns.difference(original_columns))
+    return final_df[original_columns + new_columns]
+
+
+def spill_tiles(input_path, spill_dir, chunk_rows=500000, profiler=NO_PROFILE):
+    """Primera pasada fuera de memoria: calidad y colores por bloques, reparto por tile
+
+    Cada tile se guarda en su propio fichero de `spill_dir`, al que se van
+    añadiendo (pickle) sus filas de cada bloque. Devuelve las columnas de la
+    tabla coloreada y el número de filas por tile.
+    """
+    columns = None
+    tile_rows = {}
+    for chunk in iter_table_chunks(input_path, None, chunk_rows):
+        with profiler.stage("spill_chunk", rows=len(chunk)):
+            chunk = compute_colors(apply_quality_cuts(chunk).copy())
+            if columns is None:
+                columns = chunk.columns.tolist()
+            for tile_id, part in chunk.groupby('tile_id'):
+                with open(os.path.join(spill_dir, f"tile_{tile_id}.pkl"), "ab") as f:
+                    pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+                tile_rows[tile_id] = tile_rows.get(tile_id, 0) + len(part)
+    return columns, tile_rows
+
+
+def read_spilled_tile(path):
+    """Reúne los bloques de un tile volcados por spill_tiles"""
+    parts = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                parts.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(parts) if len(parts) > 1 else parts[0]
+
+
+def select_out_of_core(input_path, output, variance_method="Fratta", sigma_threshold=5.0,
+                       chunk_rows=500000, spill_dir=None, profiler=NO_PROFILE, mc=None):
+    """Selección en dos pasadas con memoria acotada por el tile más grande
+
+    1) spill_tiles reparte el catálogo por tile en disco; 2) cada tile se
+    ajusta y puntúa por separado y sus candidatos se escriben directamente
+    en la salida (TableWriter), sin concatenar todo el catálogo.
+    """
+    tmp = tempfile.mkdtemp(prefix="jpas_spill_", dir=spill_dir)
+    try:
+        columns, tile_rows = spill_tiles(input_path, tmp, chunk_rows, profiler)
+        with TableWriter(output) as writer:
+            for tile_id in sorted(tile_rows):
+                path = os.path.join(tmp, f"tile_{tile_id}.pkl")
+                with profiler.stage("select_tile", tile=tile_id, rows=tile_rows[tile_id]):
+                    candidates = score_tile(tile_id, read_spilled_tile(path),
+                                            variance_method, sigma_threshold, mc)
+                    os.remove(path)
+                with profiler.stage("write_output", tile=tile_id, rows=len(candidates)):
+                    # Mismo orden de columnas que select_candidates
+                    new_columns = sorted(set(candidates.columns) - set(columns))
+                    writer.write(candidates[columns + new_columns])
+        return writer.rows
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def select_in_memory(args, profiler, mc):
+    """Flujo original: todo el bin en un DataFrame"""
+    # 1. Cargar y preparar datos ==========================================
+    print(f"\nCargando datos desde: {args.input_fits}")
+    df = load_data(args.input_fits, profiler)
+
+    # 2. Filtros de calidad JPAS ==========================================
+    print("Aplicando filtros de calidad...")
+    with profiler.stage("quality_query", rows=len(df)):
+        df = apply_quality_cuts(df)
+
+    # 3. Calcular pseudo-r y colores ======================================
+    print("Calculando pseudo-r y colores...")
+    with profiler.stage("pseudo_r", rows=len(df)):
+        df = compute_colors(df)
+
+    # 4. Procesamiento por tile ===========================================
+    print("Procesando por tile...")
+    with profiler.stage("select_all_tiles", rows=len(df)):
+        final_df = select_candidates(df, args.variance_method, args.sigma_threshold,
+                                     profiler, mc)
+
+    # 5. Consolidar y guardar resultados ==================================
+    print("\nGuardando resultados...")
+    with profiler.stage("write_output", rows=len(final_df)):
+        write_table(final_df, args.output)
+    return len(final_df)
+
 
 def main():
     # Configurar argumentos de línea de comandos
@@ -26,7 +331,7 @@ def main():
                       help="Ruta al archivo FITS de entrada de JPAS")
     parser.add_argument("-o", "--output", 
                       default="./resultados/halpha_candidates.csv",
-                      help="Ruta completa para el archivo de salida CSV")
+                      help="Archivo de salida: .parquet/.fits (precisión completa) o .csv")
     parser.add_argument("--variance_method", 
                       choices=["Maguio", "Mine", "Fratta"], 
                       default="Fratta",
@@ -34,129 +339,64 @@ def main():
     parser.add_argument("--sigma_threshold", 
                       type=float, default=5.0,
                       help="Umbral de selección en sigmas")
+    parser.add_argument("--mc_draws", 
+                      type=int, default=0,
+                      help="Realizaciones Monte Carlo para la probabilidad de selección (0 = corte duro)")
+    parser.add_argument("--mc_chunk", 
+                      type=int, default=2000,
+                      help="Objetos por bloque en el Monte Carlo (memoria ~ draws × chunk × 32 B)")
+    parser.add_argument("--mc_min_prob", 
+                      type=float, default=0.01,
+                      help="Guardar objetos con p_select >= valor (además de los seleccionados)")
+    parser.add_argument("--mc_seed", 
+                      type=int, default=0,
+                      help="Semilla del generador aleatorio")
+    parser.add_argument("--out_of_core", action="store_true",
+                      help="Dos pasadas por bloques con volcado por tile (memoria ~ tile más grande)")
+    parser.add_argument("--chunk_rows", 
+                      type=int, default=500000,
+                      help="Filas por bloque en la lectura fuera de memoria")
+    parser.add_argument("--spill_dir", default=None,
+                      help="Directorio para el volcado temporal por tile (por defecto el del sistema)")
+    parser.add_argument("--profile", action="store_true",
+                      help="Registrar tiempo, CPU, pico de RSS y filas por etapa y por tile")
+    parser.add_argument("--profile_output", default=None,
+                      help="JSON del perfil (por defecto <salida>_profile.json, y su .csv)")
+    parser.add_argument("--profiler", choices=["none", "cprofile", "sampling"],
+                      default="none",
+                      help="Envolver la ejecución con cProfile o pyinstrument (muestreo)")
     
     args = parser.parse_args()
+    profile_output = args.profile_output or os.path.splitext(args.output)[0] + "_profile.json"
+    profiler = StageProfiler(enabled=args.profile)
 
     # Crear directorio de salida si no existe
     output_dir = os.path.dirname(os.path.abspath(args.output))
     os.makedirs(output_dir, exist_ok=True)
 
-    # 1. Cargar y preparar datos ==============================================
-    print(f"\nCargando datos desde: {args.input_fits}")
-    with fits.open(args.input_fits) as hdul:
-        df = Table(hdul[1].data).to_pandas()
-
-    # 2. Filtros de calidad JPAS ==============================================
-    print("Aplicando filtros de calidad...")
-    df = df.query(
-        "flags_j0660 <= 3 and "
-        "mask_j0660 == 0 and "
-        "flags_isdss <= 3 and "
-        "mask_isdss == 0"
-    )
+    mc = None
+    if args.mc_draws > 0:
+        print(f"Monte Carlo: {args.mc_draws} realizaciones por objeto...")
+        mc = {"n_draws": args.mc_draws, "chunk_rows": args.mc_chunk,
+              "seed": args.mc_seed, "min_prob": args.mc_min_prob}
 
-    # 3. Calcular pseudo-r y colores ==========================================
-    print("Calculando pseudo-r y colores...")
-    
-    # Configuración de filtros
-    r_bands = ['mag_j0600_cor', 'mag_j0610_cor', 'mag_j0620_cor',
-              'mag_j0630_cor', 'mag_j0640_cor', 'mag_j0650_cor']
-    r_errors = ['err_j0600_cor', 'err_j0610_cor', 'err_j0620_cor',
-               'err_j0630_cor', 'err_j0640_cor', 'err_j0650_cor']
-    
-    # Calcular pseudo-r con promedio ponderado por SNR²
-    weights = 1 / (df[r_errors].values**2)
-    df['pseudo_r'] = np.average(df[r_bands].values, axis=1, weights=weights)
-    df['e_pseudo_r'] = np.sqrt(1 / np.sum(weights, axis=1))
-    
-    # Calcular colores y errores
-    df['color_x'] = df['pseudo_r'] - df['mag_isdss_cor']  # pseudo-r - iSDSS
-    df['color_y'] = df['pseudo_r'] - df['mag_j0660_cor']  # pseudo-r - J0660
-    
-    df['e_color_x'] = np.sqrt(df['e_pseudo_r']**2 + df['err_isdss_cor']**2)
-    df['e_color_y'] = np.sqrt(df['e_pseudo_r']**2 + df['err_j0660_cor']**2)
+    if args.out_of_core:
+        print(f"\nSelección fuera de memoria desde: {args.input_fits}")
+        with run_profiler(args.profiler, os.path.splitext(profile_output)[0]):
+            n_candidates = select_out_of_core(args.input_fits, args.output, args.variance_method,
+                                              args.sigma_threshold, args.chunk_rows,
+                                              args.spill_dir, profiler, mc)
+    else:
+        with run_profiler(args.profiler, os.path.splitext(profile_output)[0]):
+            n_candidates = select_in_memory(args, profiler, mc)
 
-    # 4. Procesamiento por tile ===============================================
-    print("Procesando por tile...")
-    all_candidates = []
-    
-    for tile_id, tile_data in df.groupby('tile_id'):
-        # A. Ajuste del locus estelar
-        fitter = fitting.LinearLSQFitter()
-        model = models.Linear1D()
-        
-        # Ajuste con sigma-clipping (4σ, 5 iteraciones)
-        fitted_model, mask = fitting.FittingWithOutlierRemoval(
-            fitter, 
-            sigma_clip, 
-            sigma=4.0, 
-            niter=5
-        )(model, tile_data['color_x'], tile_data['color_y'])
-        
-        # B. Calcular parámetros clave
-        residuals = tile_data['color_y'] - fitted_model(tile_data['color_x'])
-        sigma_int = np.std(residuals[mask])
-        m = fitted_model.slope.value
-        b = fitted_model.intercept.value
-        
-        # C. Calcular varianza total
-        if args.variance_method == "Maguio":
-            var = (
-                sigma_int**2 + 
-                m**2 * tile_data['e_color_x']**2 + 
-                (1 - m)**2 * tile_data['e_color_y']**2 +
-                tile_data['err_j0660_cor']**2
-            )
-        elif args.variance_method == "Mine":
-            var = (
-                sigma_int**2 +
-                m**2 * tile_data['e_color_x']**2 +
-                (1 - m)**2 * tile_data['e_color_y']**2
-            )
-        else:  # Fratta
-            var = (
-                sigma_int**2 + 
-                m**2 * tile_data['e_color_x']**2 + 
-                tile_data['e_color_y']**2
-            )
-        
-        threshold = args.sigma_threshold * np.sqrt(var)
-        
-        # D. Seleccionar candidatos
-        ha_mask = residuals >= threshold
-        candidates = tile_data[ha_mask].copy()
-        
-        # Añadir metadatos del ajuste
-        candidates['slope'] = m
-        candidates['intercept'] = b
-        candidates['sigma_int'] = sigma_int
-        candidates['tile_id'] = tile_id
-        
-        all_candidates.append(candidates)
-
-    # ... (parte inicial del código se mantiene igual)
-
-    # 5. Consolidar y guardar resultados ======================================
-    print("\nGuardando resultados...")
-    final_df = pd.concat(all_candidates, ignore_index=True)
-    
-    # Ordenar columnas: originales primero, nuevas al final
-    original_columns = df.columns.tolist()
-    new_columns = list(final_df.columns.difference(original_columns))
-    final_df = final_df[original_columns + new_columns]
-    
-    # Guardar todos los campos
-    final_df.to_csv(
-        args.output,
-        index=False,
-        float_format="%.4f",
-        encoding='utf-8'
-    )
-    
-    print(f"\n✅ Proceso completado! {len(final_df)} candidatos guardados en:")
+    print(f"\n✅ Proceso completado! {n_candidates} candidatos guardados en:")
     print(f"📄 {os.path.abspath(args.output)}")
 
-# ... (resto del código se mantiene igual)
+    if args.profile:
+        profiler.print_summary()
+        profiler.write(profile_output)
+        print(f"📄 Perfil: {os.path.abspath(profile_output)}")
 
 if __name__ == "__main__":
     main()